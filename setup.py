@@ -8,6 +8,7 @@ setup(
         'vivian_airflow_extensions.hooks',
         'vivian_airflow_extensions.operators',
         'vivian_airflow_extensions.sensors',
+        'vivian_airflow_extensions.triggers',
     ],
     install_requires=['apache-airflow']
 )
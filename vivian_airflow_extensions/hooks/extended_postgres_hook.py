@@ -1,46 +1,355 @@
+import csv
+import io
+import logging
+import queue
+import struct
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from decimal import Decimal
+
 from airflow.utils.decorators import apply_defaults
 from airflow.providers.postgres.hooks.postgres import PostgresHook
+from airflow.exceptions import AirflowException
+
+
+PG_BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PG_BINARY_COPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_DATE = date(2000, 1, 1)
+
+
+def _quote_identifier(name):
+    """
+    Quote an identifier the way Postgres' quote_ident does, so names with
+    uppercase letters, quotes or spaces are passed through unchanged.
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _encode_numeric(value):
+    """
+    Encode a value in the Postgres binary numeric format: a header followed by
+    base-10000 digits aligned on the decimal point.
+    """
+    if isinstance(value, float):
+        # Decimal(0.1) is the float's exact binary expansion, 55 digits long; use
+        # the shortest repr instead, which is what the CSV path writes
+        value = repr(value)
+    value = Decimal(value)
+    if value.is_nan():
+        return struct.pack('>hhHH', 0, 0, 0xC000, 0)
+    if value.is_infinite():
+        raise AirflowException('Infinite numeric values are not supported by the binary COPY writer')
+
+    sign, digits, exponent = value.as_tuple()
+    digits = ''.join(map(str, digits))
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+
+    integer_length = len(digits) + exponent
+    if integer_length >= 0:
+        integer, fraction = digits[:integer_length], digits[integer_length:]
+    else:
+        integer, fraction = '', '0' * -integer_length + digits
+
+    integer = integer.zfill(-(-len(integer) // 4) * 4)
+    fraction = fraction.ljust(-(-len(fraction) // 4) * 4, '0')
+    padded = integer + fraction
+    groups = [int(padded[i:i + 4]) for i in range(0, len(padded), 4)]
+    weight = len(integer) // 4 - 1
+
+    while groups and groups[0] == 0:
+        groups.pop(0)
+        weight -= 1
+    while groups and groups[-1] == 0:
+        groups.pop()
+    if not groups:
+        weight = 0
+
+    return struct.pack(f'>hhHH{len(groups)}H', len(groups), weight, 0x4000 if sign else 0, -exponent, *groups)
+
+
+def _encode_timestamp(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = value - PG_EPOCH
+    return struct.pack('>q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+
+
+def _encode_date(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return struct.pack('>i', (value - PG_EPOCH_DATE).days)
+
+
+def _encode_text(value):
+    return str(value).encode('utf-8')
+
+
+# Binary encoders keyed by information_schema.columns.data_type
+PG_BINARY_ENCODERS = {
+    'smallint': lambda value: struct.pack('>h', int(value)),
+    'integer': lambda value: struct.pack('>i', int(value)),
+    'bigint': lambda value: struct.pack('>q', int(value)),
+    'real': lambda value: struct.pack('>f', float(value)),
+    'double precision': lambda value: struct.pack('>d', float(value)),
+    'numeric': _encode_numeric,
+    'boolean': lambda value: struct.pack('>?', bool(value)),
+    'text': _encode_text,
+    'character varying': _encode_text,
+    'character': _encode_text,
+    'json': _encode_text,
+    'jsonb': lambda value: b'\x01' + _encode_text(value),
+    'uuid': lambda value: uuid.UUID(str(value)).bytes,
+    'date': _encode_date,
+    'timestamp without time zone': _encode_timestamp,
+    'timestamp with time zone': _encode_timestamp,
+}
+
+
+class _IteratorStream(io.RawIOBase):
+    """
+    A read-only file-like object over an iterator of bytes, so that generated
+    data can be handed to copy_expert without staging it in a file first.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._offset >= len(self._buffer):
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+            self._offset = 0
+
+        # a view into the current chunk, so reading it in pieces doesn't copy what's left each time
+        size = min(len(buffer), len(self._buffer) - self._offset)
+        buffer[:size] = self._buffer[self._offset:self._offset + size]
+        self._offset += size
+        return size
 
 
 class ExtendedPostgresHook(PostgresHook): 
     """
     This class extends the PostgresHook to provide additional functionality.
     """
+    # idle connections and lease slots, shared by every hook in the process and keyed by postgres_conn_id
+    _pools = {}
+    _pool_slots = {}
+    _pools_lock = threading.Lock()
+    # table metadata keyed by (postgres_conn_id, schema, table, include_autoincrement_keys)
+    _metadata_cache = {}
+    _metadata_cache_lock = threading.Lock()
+
     @apply_defaults
-    def __init__(self, postgres_conn_id='postgres_default', *args, **kwargs) -> None:
+    def __init__(self, postgres_conn_id='postgres_default', pool_size: int=4, pool_recycle: int=300,
+                 copy_chunk_bytes: int=1 << 20, metadata_cache_ttl: int=300, *args, **kwargs) -> None:
         """
         Initialize a new instance of ExtendedPostgresHook.
 
         :param postgres_conn_id: The ID of the connection to use.
+        :param pool_size: The maximum number of connections open at once for this
+            connection ID, and the number of idle connections kept open. Operators
+            close them with close_pool when they finish.
+        :param pool_recycle: Idle connections older than this many seconds are
+            closed instead of being reused.
+        :param copy_chunk_bytes: The number of bytes read from the file or stream
+            and sent to Postgres at a time by every COPY. Defaults to 1 MiB.
+        :param metadata_cache_ttl: The number of seconds get_table_metadata reuses
+            the metadata it fetched for a table. Set to 0 to always query the catalog.
         """
         super().__init__(*args, **kwargs)
 
         self.postgres_conn_id = postgres_conn_id
-         
-    def _run_psql_commands_in_transaction(self, commands):
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.copy_chunk_bytes = copy_chunk_bytes
+        self.metadata_cache_ttl = metadata_cache_ttl
+
+    @classmethod
+    def close_pools(cls):
         """
-        Run a list of SQL commands in a single transaction.
+        Close every idle pooled connection.
+        """
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+            cls._pool_slots.clear()
+
+        for pool in pools:
+            cls._close_idle_connections(pool)
+
+    @staticmethod
+    def _close_idle_connections(pool):
+        while True:
+            try:
+                conn, _ = pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
 
-        :param commands: The list of SQL commands to run.
+    def close_pool(self):
+        """
+        Close the idle connections pooled for this hook's connection ID. Connections
+        still in use are closed when they're released.
+        """
+        with self._pools_lock:
+            pool = self._pools.pop(self.postgres_conn_id, None)
+            self._pool_slots.pop(self.postgres_conn_id, None)
+
+        if pool is not None:
+            self._close_idle_connections(pool)
+
+    @classmethod
+    def clear_metadata_cache(cls):
+        """
+        Forget the table metadata cached by get_table_metadata.
         """
-        conn = self.get_conn()
-        cursor = conn.cursor()
-        self.log.debug('[_run_psql_commands_in_transaction] -  running commands')
-        self.log.info('\n' + '\n'.join(f"    {command}" for command in commands))
+        with cls._metadata_cache_lock:
+            cls._metadata_cache.clear()
+
+    def _get_pool(self):
+        with self._pools_lock:
+            if self.postgres_conn_id not in self._pools:
+                self._pools[self.postgres_conn_id] = queue.LifoQueue(maxsize=self.pool_size)
+                self._pool_slots[self.postgres_conn_id] = threading.BoundedSemaphore(self.pool_size)
+            return self._pools[self.postgres_conn_id], self._pool_slots[self.postgres_conn_id]
+
+    def _release_connection(self, pool, conn):
+        if conn.closed:
+            return
 
         try:
-            for cmd in commands:
-                self.log.debug('[_run_psql_commands_in_transaction] : cmd %s', cmd)
-                cursor.execute(cmd)
-            conn.commit()
-        except Exception as e:
+            # never hand out a connection with an open transaction
             conn.rollback()
-            self.log.critical("[_run_psql_commands_in_transaction] error: {}".format(e))
-            print(cmd)
-            raise e
-        finally:
-            self.log.debug('[_run_psql_commands_in_transaction] -  closing conn')
+            with self._pools_lock:
+                # the pool may have been closed while the connection was in use
+                if self._pools.get(self.postgres_conn_id) is pool:
+                    pool.put_nowait((conn, time.monotonic()))
+                    return
+            conn.close()
+        except queue.Full:
             conn.close()
+        except Exception as e:
+            self.log.warning(f'Discarding broken pooled connection: {e}')
+            conn.close()
+
+    @contextmanager
+    def _connection(self):
+        """
+        Lease a connection from the pool, opening a new one with get_conn if no
+        idle connection is available. At most pool_size connections are leased at
+        once; further callers wait for one to be returned. The connection is
+        returned to the pool when the block exits.
+        """
+        pool, slots = self._get_pool()
+        slots.acquire()
+        conn = None
+
+        try:
+            while conn is None:
+                try:
+                    conn, released_at = pool.get_nowait()
+                except queue.Empty:
+                    conn = self.get_conn()
+                    break
+                if conn.closed or time.monotonic() - released_at > self.pool_recycle:
+                    conn.close()
+                    conn = None
+
+            try:
+                yield conn
+            finally:
+                self._release_connection(pool, conn)
+        finally:
+            slots.release()
+         
+    def _join_commands(self, commands):
+        """
+        Join a list of SQL commands into a single multi-statement string.
+
+        :param commands: The list of SQL commands to join.
+        """
+        return '\n'.join(command if command.rstrip().endswith(';') else f'{command};' for command in commands)
+
+    def _log_failing_command(self, error, commands):
+        """
+        Log which of a batch of SQL commands failed, from the diagnostics Postgres
+        sent back with the error. Nothing is run again.
+
+        :param error: The error raised by the batch.
+        :param commands: The list of SQL commands that failed as a batch.
+        """
+        diag = getattr(error, 'diag', None)
+        if diag is None:
+            return
+
+        self.log.error('[_run_psql_commands_in_transaction] %s (detail: %s, table: %s, constraint: %s)',
+                       diag.message_primary, diag.message_detail, diag.table_name, diag.constraint_name)
+
+        # the position is counted from the start of the joined batch, one-based
+        if diag.statement_position is None:
+            return
+        position = int(diag.statement_position) - 1
+        start = 0
+        for cmd in commands:
+            end = start + len(self._join_commands([cmd]))
+            if position < end:
+                self.log.error('[_run_psql_commands_in_transaction] failed command: %s', cmd)
+                return
+            start = end + 1
+
+    def _run_psql_commands_in_transaction(self, commands):
+        """
+        Run a list of SQL commands in a single transaction.
+
+        The commands are sent as one multi-statement execute, so the whole batch
+        costs a single round trip. On psycopg 3 connections they are queued in
+        pipeline mode instead, which also avoids waiting on each response; the
+        pipeline still runs inside the one transaction, so a failure rolls back
+        every command. If the batch fails, the command that caused the error is
+        logged from the error's diagnostics.
+
+        :param commands: The list of SQL commands to run.
+        """
+        # the batch can be large, so only build the message when debug logging is on
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('[_run_psql_commands_in_transaction] -  running commands:\n%s', '\n'.join(f"    {command}" for command in commands))
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if hasattr(conn, 'pipeline'):
+                    with conn.pipeline():
+                        for cmd in commands:
+                            cursor.execute(cmd)
+                else:
+                    cursor.execute(self._join_commands(commands))
+                conn.commit()
+            except Exception as e:
+                try:
+                    conn.rollback()
+                except Exception as rollback_error:
+                    # the original error is the one worth raising
+                    self.log.error(f'[_run_psql_commands_in_transaction] rollback failed: {rollback_error}')
+                self.log.critical("[_run_psql_commands_in_transaction] error: {}".format(e))
+                self._log_failing_command(e, commands)
+                raise
     
     def _generate_drop_table_attributes_commands(self, table):
         """
@@ -56,143 +365,192 @@ class ExtendedPostgresHook(PostgresHook):
         :return: A list of SQL commands to drop the table's constraints, indexes, and sequences.
         :rtype: list of str
         """
-        conn = self.get_conn()
-        cursor = conn.cursor()
-
-        # Fetch all constraint names from the table
-        cursor.execute(f"""
-            select conname
-            from pg_constraint 
-            inner join pg_class on conrelid=pg_class.oid 
-            where relname='{table}';
-        """)
-
-        self.drop_constraint_commands = [f'alter table "{table}" drop constraint if exists "{row[0]}";' for row in cursor.fetchall() if row[0]]
-
-        # Fetch all index names from the table
-        cursor.execute(f"""
-            select indexname
-            from pg_indexes 
-            where tablename='{table}';
-        """)
-
-        self.drop_index_commands = [f'drop index if exists "{row[0]}";' for row in cursor.fetchall() if row[0]]
+        # Fetch all constraint and index names from the table in one round trip
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                select 'constraint', conname
+                from pg_constraint 
+                inner join pg_class on conrelid=pg_class.oid 
+                where relname = %(table)s
+                union all
+                select 'index', indexname
+                from pg_indexes 
+                where tablename = %(table)s;
+            """, {'table': table})
+            results = cursor.fetchall()
+
+        self.drop_constraint_commands = [f'alter table {_quote_identifier(table)} drop constraint if exists {_quote_identifier(row[1])};' for row in results if row[0] == 'constraint' and row[1]]
+        self.drop_index_commands = [f'drop index if exists {_quote_identifier(row[1])};' for row in results if row[0] == 'index' and row[1]]
     
     def _get_table_columns(self, table, cursor):
-        columns_sql_query = f"""
+        columns_sql_query = """
             select 
                 column_name, 
                 data_type, 
                 column_default 
             from information_schema.columns 
-            where table_name = '{table}'
+            where table_name = %(table)s
             order by ordinal_position;
         """
 
-        cursor.execute(columns_sql_query)
+        cursor.execute(columns_sql_query, {'table': table})
         columns_results = cursor.fetchall()
         return columns_results
 
-    def _get_table_constraints(self, table, cursor):
-        constraints_sql_query = f"""
-            select
-                conname, 
-                pg_get_constraintdef(oid),
-                contype
-            from pg_constraint 
-            where replace(conrelid::regclass::text, '"', '') = '{table}';
+    def _get_table_metadata_rows(self, table, schema, cursor):
         """
+        Retrieves the columns, constraints, indexes, and sequences of a table in a
+        single round trip.
 
-        cursor.execute(constraints_sql_query)
-        constraints_results = cursor.fetchall()
-        return constraints_results
+        The four catalog queries are combined with UNION ALL. Every row is tagged
+        with its kind ('cols', 'cons', 'idx' or 'seq') and padded to the same
+        number of columns.
 
-    def _get_table_indexes(self, table, cursor):
-        indexes_sql_query = f"""
-            select indexname, indexdef
+        :param table: The name of the table for which to retrieve the metadata.
+        :param schema: The schema the table's sequences live in.
+        :param cursor: The cursor to run the query with.
+
+        :return: The rows for each kind, without the kind and position columns.
+        :rtype: dict of str to list of tuple
+        """
+        metadata_sql_query = """
+            select 'cols', ordinal_position, column_name::text, data_type::text, column_default::text, null, null, null, null
+            from information_schema.columns
+            where table_name = %(table)s
+            union all
+            select 'cons', 0, conname::text, pg_get_constraintdef(oid), contype::text, null, null, null, null
+            from pg_constraint
+            where replace(conrelid::regclass::text, '"', '') = %(table)s
+            union all
+            select 'idx', 0, indexname::text, indexdef, null, null, null, null, null
             from pg_indexes
-            where tablename = '{table}';
+            where tablename = %(table)s
+            union all
+            select 'seq', ordinal_position, column_name::text, sequencename::text, increment_by::text,
+                min_value::text, max_value::text, last_value::text, cycle::text
+            from information_schema.columns
+            inner join pg_sequences
+                on schemaname = %(schema)s
+                and sequencename = trim(both '"' from regexp_replace(split_part(column_default, '''', 2), '^.*[.]', ''))
+            where table_name = %(table)s
+                and data_type in ('integer', 'smallint', 'bigint')
+                and column_default like '%%nextval%%'
+            order by 1, 2;
         """
 
-        cursor.execute(indexes_sql_query)
-        indexes_results = cursor.fetchall()
-        return indexes_results
+        cursor.execute(metadata_sql_query, {'table': table, 'schema': schema})
 
-    def _get_table_sequences(self, cursor, schema, columns_results):
+        metadata = defaultdict(list)
+        for row in cursor.fetchall():
+            metadata[row[0]].append(row[2:])
+        return metadata
+
+    def _get_table_sequences(self, sequences_results):
         """
-        Retrieves the sequences associated with a given table.
+        Builds the sequences associated with a given table.
 
-        This function queries the PostgreSQL system catalogs to find sequences 
-        that are associated with the specified table. Sequences are database objects 
-        that are often used to create unique identifiers for rows in a table.
+        Sequences are database objects that are often used to create unique
+        identifiers for rows in a table. Each result row holds the column the
+        sequence is the default for, followed by the sequence's properties from
+        pg_sequences.
 
-        :param table: The name of the table for which to retrieve the sequences.
-        :type table: str
+        :param sequences_results: The 'seq' rows from _get_table_metadata_rows.
+        :type sequences_results: list of tuple
 
-        :return: A list of sequences associated with the table.
-        :rtype: list of str
+        :return: None. The sequences are stored in self.sequences.
         """
         self.sequences = []
-        for column in columns_results:
-            # Checks if the column is a sequence
-            if column[1] in ['integer', 'smallint', 'bigint'] and column[2] is not None and 'nextval' in column[2]:
-                seq_results = column[2].split("'")[1]
-                seq_name = seq_results.split('.')[-1].strip('"')
-
-                # Get the existing sequence's properties
-                cursor.execute(f"""
-                    select sequencename, increment_by, min_value, max_value, last_value, cycle
-                    from pg_sequences 
-                    where schemaname = '{schema}' and sequencename = '{seq_name}';
-                """)
-                seq_properties = cursor.fetchone()
-
-                self.sequences.append({
-                    'name': seq_properties[0],
-                    'column': column[0],
-                    'increment': seq_properties[1],
-                    'minvalue': seq_properties[2],
-                    'maxvalue': seq_properties[3],
-                    'last': seq_properties[4] if seq_properties[4] is not None else seq_properties[2],
-                    'cycle': ' cycle' if seq_properties[5] else '',
-                })
+        for column, name, increment, minvalue, maxvalue, last, cycle in sequences_results:
+            self.sequences.append({
+                'name': name,
+                'column': column,
+                'increment': int(increment),
+                'minvalue': int(minvalue),
+                'maxvalue': int(maxvalue),
+                'last': int(last if last is not None else minvalue),
+                'cycle': ' cycle' if cycle == 'true' else '',
+            })
+
+    def _refresh_sequence_last_values(self, schema):
+        """
+        Update the last value of each sequence in self.sequences, which moves on
+        every load even when the rest of the table metadata doesn't change.
+
+        :param schema: The schema the table's sequences live in.
+        """
+        if not self.sequences:
+            return
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                'select sequencename::text, last_value from pg_sequences where schemaname = %(schema)s and sequencename = any(%(names)s);',
+                {'schema': schema, 'names': [seq['name'] for seq in self.sequences]},
+            )
+            last_values = dict(cursor.fetchall())
+
+        for seq in self.sequences:
+            last = last_values.get(seq['name'])
+            seq['last'] = int(last) if last is not None else seq['minvalue']
 
     def get_table_metadata(self, table, schema, include_autoincrement_keys):
         """
         Retrieves metadata for a given table.
 
         This function retrieves various types of metadata for the specified table, 
-        including the schema, columns, constraints, indexes, and sequences. It uses 
-        several helper functions to retrieve each type of metadata.
+        including the schema, columns, constraints, indexes, and sequences. All of
+        it is fetched with a single query.
+
+        The result is cached for metadata_cache_ttl seconds and shared by every
+        hook in the process. On a cache hit only the sequences' last values are
+        read again.
 
         :param table: The name of the table for which to retrieve the metadata.
         :type table: str
 
         :return: None. The metadata is stored in instance variables.
         """
-        conn = self.get_conn()
-        cursor = conn.cursor()
-
-        try:
-            columns_results = self._get_table_columns(table, cursor)
-            constraints_results = self._get_table_constraints(table, cursor)
-            indexes_results = self._get_table_indexes(table, cursor)
-            self._get_table_sequences(cursor, schema, columns_results)
-        except Exception as e:
-            self.log.critical("[get_table_metadata] error: {}".format(e))
-            raise e
-        finally:
-            conn.close()
+        cache_key = (self.postgres_conn_id, schema, table, include_autoincrement_keys)
+        with self._metadata_cache_lock:
+            cached = self._metadata_cache.get(cache_key)
+
+        if cached is not None and time.monotonic() - cached[0] < self.metadata_cache_ttl:
+            _, columns_list, self.constraints, self.indexes, sequences = cached
+            self.sequences = [dict(seq) for seq in sequences]
+            self._refresh_sequence_last_values(schema)
+            return list(columns_list)
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                metadata = self._get_table_metadata_rows(table, schema, cursor)
+            except Exception as e:
+                self.log.critical("[get_table_metadata] error: {}".format(e))
+                raise e
+
+        columns_results = metadata['cols']
+        constraints_results = metadata['cons']
+        indexes_results = metadata['idx']
+        self._get_table_sequences(metadata['seq'])
         
         self.constraints = [{'name': row[0], 'definition': row[1], 'type': row[2]} for row in constraints_results]
 
-        constraints_names = [constraint[0] for constraint in constraints_results]  
+        constraints_names = frozenset(constraint[0] for constraint in constraints_results)
         self.indexes = [{'name': index[0], 'definition': index[1]} for index in indexes_results if index[0] not in constraints_names]
 
         if include_autoincrement_keys:
             columns_list = [column[0] for column in columns_results]
         else:
-            columns_list = [column[0] for column in columns_results if column[0] not in [seq['column'] for seq in self.sequences]]
+            sequence_columns = frozenset(seq['column'] for seq in self.sequences)
+            columns_list = [column[0] for column in columns_results if column[0] not in sequence_columns]
+
+        if self.metadata_cache_ttl > 0:
+            with self._metadata_cache_lock:
+                self._metadata_cache[cache_key] = (
+                    time.monotonic(), tuple(columns_list), self.constraints, self.indexes, [dict(seq) for seq in self.sequences]
+                )
 
         return columns_list
     
@@ -215,27 +573,25 @@ class ExtendedPostgresHook(PostgresHook):
         self.swap_table = f'Swap{table}'
 
         # Drop old temp and swap tables if they exist
+        tmp_table = _quote_identifier(self.tmp_table)
+
         prep_commands.extend([
-            f'drop table if exists "{self.tmp_table}" cascade;',
-            f'drop table if exists "{self.swap_table}" cascade;',
-            f'create table "{self.tmp_table}" (like "{table}" including all);'
+            f'drop table if exists {tmp_table} cascade;',
+            f'drop table if exists {_quote_identifier(self.swap_table)} cascade;',
+            # no indexes or constraints while loading: swap_db_tables adds the table's own back
+            # after the data is in, and the merge operators only read the tmp table
+            f'create table {tmp_table} (like {_quote_identifier(table)} including all excluding indexes excluding constraints);'
         ])
         
         # Create a temporary sequence for each sequence in the original table
         for seq in self.sequences:
-            sequence_name = seq['name']
-            tmp_sequence_name = f'Tmp{sequence_name}'
+            tmp_sequence_name = _quote_identifier(f'Tmp{seq["name"]}')
             prep_commands.extend([
-                f'drop sequence if exists "{tmp_sequence_name}" cascade;',
-                f'create sequence "{tmp_sequence_name}" increment {seq["increment"]} minvalue {seq["minvalue"]} maxvalue {seq["maxvalue"]} start with {seq["last"]} {seq["cycle"]};',
-                f'alter table "{self.tmp_table}" alter column "{seq["column"]}" set default nextval(\'"{tmp_sequence_name}"\');'
+                f'drop sequence if exists {tmp_sequence_name} cascade;',
+                f'create sequence {tmp_sequence_name} increment {seq["increment"]} minvalue {seq["minvalue"]} maxvalue {seq["maxvalue"]} start with {seq["last"]} {seq["cycle"]};',
+                f'alter table {tmp_table} alter column {_quote_identifier(seq["column"])} set default nextval({_quote_literal(tmp_sequence_name)});'
             ])
 
-        # Create a temporary foreign key for each foreign key in the original table
-        for constraint in self.constraints:
-            if constraint['type'] == 'f':
-                prep_commands.append(f'alter table "{self.tmp_table}" add constraint "Tmp{constraint["name"]}" {constraint["definition"]};')
-
         self._run_psql_commands_in_transaction(prep_commands)
         self._generate_drop_table_attributes_commands(self.tmp_table)
 
@@ -243,24 +599,92 @@ class ExtendedPostgresHook(PostgresHook):
         """
         Write data from a file to a table in the database.
 
-        :param file: The file containing the data to write.
+        :param file: The file containing the data to write. Non-seekable streams,
+            such as the read end of a pipe, are read from their current position.
         :param columns_string: The columns to write the data to.
         :param table: The table to write the data to.
         """
-        file.seek(0)
-        conn = self.get_conn()
-        cursor = conn.cursor()
+        if file.seekable():
+            file.seek(0)
 
         self.log.info(table)
         self.log.info(columns_string)
 
-        write_to_db_sql = f'copy "{table}" ({columns_string}) from stdin with csv delimiter \'|\' quote \'"\' header null as \'\''
+        write_to_db_sql = f'copy {_quote_identifier(table)} ({columns_string}) from stdin with csv delimiter \'|\' quote \'"\' header null as \'\''
         
         self.log.info(f'writing command: {write_to_db_sql}')
-        cursor.copy_expert(write_to_db_sql, file)
-        conn.commit()
-        conn.close()
-    
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.copy_expert(write_to_db_sql, file, size=self.copy_chunk_bytes)
+            conn.commit()
+
+    def _generate_csv_copy_chunks(self, row_chunks):
+        """
+        Encode chunks of rows in the CSV format read by copy_from_iter, one chunk of
+        bytes per chunk of rows. Empty chunks are skipped.
+
+        :param row_chunks: The rows to encode, as an iterable of chunks of rows.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter='|', quotechar='"')
+
+        for rows in row_chunks:
+            writer.writerows(rows)
+            if buffer.tell():
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+
+    def copy_from_iter(self, row_chunks, columns_string, table):
+        """
+        Stream chunks of rows into a table with a single COPY, encoding each chunk
+        as it is read. Nothing is staged in a file, and only one chunk is held in
+        memory at a time.
+
+        :param row_chunks: The rows to write, as an iterable of chunks of rows with
+            the values in column order.
+        :param columns_string: The columns to write the data to.
+        :param table: The table to write the data to.
+        :return: True if any rows were written, False otherwise.
+        """
+        wrote_rows = False
+
+        def track_rows(chunks):
+            nonlocal wrote_rows
+            for rows in chunks:
+                wrote_rows = wrote_rows or bool(rows)
+                yield rows
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if hasattr(cursor, 'copy_expert'):
+                write_to_db_sql = f'copy {_quote_identifier(table)} ({columns_string}) from stdin with csv delimiter \'|\' quote \'"\' null as \'\''
+                self.log.info(f'writing command: {write_to_db_sql}')
+                chunks = self._generate_csv_copy_chunks(track_rows(row_chunks))
+                cursor.copy_expert(write_to_db_sql, io.BufferedReader(_IteratorStream(chunks)), size=self.copy_chunk_bytes)
+            else:
+                # psycopg 3 adapts and sends each row itself
+                write_to_db_sql = f'copy {_quote_identifier(table)} ({columns_string}) from stdin'
+                self.log.info(f'writing command: {write_to_db_sql}')
+                with cursor.copy(write_to_db_sql) as copy:
+                    for rows in track_rows(row_chunks):
+                        for row in rows:
+                            copy.write_row(row)
+            conn.commit()
+
+        return wrote_rows
+
+    def copy_rows_direct(self, rows, columns_string, table):
+        """
+        Write rows that are already in memory to a table with a single COPY, without
+        staging them in a file first. Meant for small results.
+
+        :param rows: The rows to write, as sequences of values in column order.
+        :param columns_string: The columns to write the data to.
+        :param table: The table to write the data to.
+        """
+        self.copy_from_iter([rows], columns_string, table)
+
     def swap_db_tables(self, table, prep_commands=None):
         """
         Swap the given table and a temporary table.
@@ -277,35 +701,134 @@ class ExtendedPostgresHook(PostgresHook):
             prep_commands.extend(self.drop_index_commands)
             
             for seq in self.sequences:
-                prep_commands.append(f'drop sequence if exists "{seq["name"]}" cascade;')
+                prep_commands.append(f'drop sequence if exists {_quote_identifier(seq["name"])} cascade;')
 
             # Swap the tables and drop the old table
             prep_commands.extend([
-                f'alter table if exists "{table}" rename to "{self.swap_table}";',
-                f'alter table if exists "{self.tmp_table}" rename to "{table}";',
-                f'drop table if exists "{self.swap_table}" cascade;'
+                f'alter table if exists {_quote_identifier(table)} rename to {_quote_identifier(self.swap_table)};',
+                f'alter table if exists {_quote_identifier(self.tmp_table)} rename to {_quote_identifier(table)};',
+                f'drop table if exists {_quote_identifier(self.swap_table)} cascade;'
             ])
 
             # Add the correctly named constraints, indexes, and sequences
             for constraint in self.constraints:
-                prep_commands.append(f'alter table if exists "{table}" add constraint "{constraint["name"]}" {constraint["definition"]};')
+                prep_commands.append(f'alter table if exists {_quote_identifier(table)} add constraint {_quote_identifier(constraint["name"])} {constraint["definition"]};')
 
             for index in self.indexes:
                 prep_commands.append(f'{index["definition"]};')
             
             for seq in self.sequences:
-                sequence_name = seq['name']
-                tmp_sequence_name = f'Tmp{sequence_name}'
+                sequence_name = _quote_identifier(seq['name'])
+                tmp_sequence_name = _quote_identifier(f'Tmp{seq["name"]}')
                 prep_commands.extend([
-                    f'alter sequence "{tmp_sequence_name}" rename to "{sequence_name}";'
-                    f'alter table "{table}" alter column "{seq["column"]}" set default nextval(\'"{sequence_name}"\');'
+                    f'alter sequence {tmp_sequence_name} rename to {sequence_name};',
+                    f'alter table {_quote_identifier(table)} alter column {_quote_identifier(seq["column"])} set default nextval({_quote_literal(sequence_name)});'
                 ])
         
         else:
-            prep_commands.append(f'drop table if exists "{self.tmp_table}" cascade;')
+            # a new list, so the caller's commands aren't extended
+            prep_commands = list(prep_commands)
+            prep_commands.append(f'drop table if exists {_quote_identifier(self.tmp_table)} cascade;')
             for seq in self.sequences:
-                sequence_name = seq['name']
-                tmp_sequence_name = f'Tmp{sequence_name}'
-                prep_commands.append(f'drop sequence if exists "{tmp_sequence_name}" cascade;')
+                prep_commands.append(f'drop sequence if exists {_quote_identifier("Tmp" + seq["name"])} cascade;')
 
         self._run_psql_commands_in_transaction(prep_commands)
+
+    def _generate_binary_copy_chunks(self, row_chunks, encoders):
+        """
+        Generate the Postgres binary COPY stream for chunks of rows: the header,
+        one tuple per row (field count, then length and bytes for each field) and
+        the trailer.
+
+        :param row_chunks: The rows to encode, as an iterable of chunks of rows.
+        :param encoders: One binary encoder per column of the rows.
+        """
+        yield PG_BINARY_COPY_HEADER
+
+        field_count = struct.pack('>h', len(encoders))
+        null_field = struct.pack('>i', -1)
+
+        for rows in row_chunks:
+            chunk = []
+            for row in rows:
+                chunk.append(field_count)
+                for value, encode in zip(row, encoders):
+                    if value is None:
+                        chunk.append(null_field)
+                    else:
+                        data = encode(value)
+                        chunk.append(struct.pack('>i', len(data)))
+                        chunk.append(data)
+            yield b''.join(chunk)
+
+        yield PG_BINARY_COPY_TRAILER
+
+    def _copy_binary(self, row_chunks, columns, table):
+        """
+        Write chunks of rows to a table using binary COPY, encoding each value
+        according to the type of the Postgres column it goes into.
+
+        :param row_chunks: The rows to write, as an iterable of chunks of rows.
+        :param columns: The names of the columns the row values go into, in order.
+        :param table: The table to write the data to.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            column_types = {column[0]: column[1] for column in self._get_table_columns(table, cursor)}
+
+            encoders = []
+            for column in columns:
+                data_type = column_types.get(column)
+                if data_type not in PG_BINARY_ENCODERS:
+                    raise AirflowException(f'Column {column} of type {data_type} is not supported by the binary COPY writer')
+                encoders.append(PG_BINARY_ENCODERS[data_type])
+
+            columns_string = ", ".join(map(_quote_identifier, columns))
+            write_to_db_sql = f'copy {_quote_identifier(table)} ({columns_string}) from stdin with (format binary)'
+            self.log.info(f'writing command: {write_to_db_sql}')
+
+            chunks = self._generate_binary_copy_chunks(row_chunks, encoders)
+            if hasattr(cursor, 'copy_expert'):
+                cursor.copy_expert(write_to_db_sql, io.BufferedReader(_IteratorStream(chunks)), size=self.copy_chunk_bytes)
+            else:
+                # psycopg 3 exposes COPY as a context manager instead
+                with cursor.copy(write_to_db_sql) as copy:
+                    for chunk in chunks:
+                        copy.write(chunk)
+            conn.commit()
+
+    def write_to_db_binary(self, arrow_table, table):
+        """
+        Write an Arrow table to a table in the database using binary COPY, which
+        skips the text parsing Postgres does for CSV input.
+
+        The Arrow columns are matched to the table's columns by name and encoded
+        according to the Postgres column types.
+
+        :param arrow_table: The Arrow table containing the data to write.
+        :param table: The table to write the data to.
+        """
+        row_chunks = (zip(*(column.to_pylist() for column in batch.columns)) for batch in arrow_table.to_batches())
+        self._copy_binary(row_chunks, arrow_table.column_names, table)
+
+    def write_rows_to_db_binary(self, row_chunks, columns, table):
+        """
+        Stream chunks of rows, such as the ones fetched from a Snowflake cursor, into
+        a table using binary COPY. Nothing is staged in a file and no CSV is written
+        or parsed. Array columns are not supported.
+
+        :param row_chunks: The rows to write, as an iterable of chunks of rows.
+        :param columns: The names of the columns the row values go into, in order.
+        :param table: The table to write the data to.
+        :return: True if any rows were written, False otherwise.
+        """
+        wrote_rows = False
+
+        def track_rows(chunks):
+            nonlocal wrote_rows
+            for rows in chunks:
+                wrote_rows = wrote_rows or bool(rows)
+                yield rows
+
+        self._copy_binary(track_rows(row_chunks), columns, table)
+        return wrote_rows
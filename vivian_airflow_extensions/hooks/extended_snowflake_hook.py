@@ -1,86 +1,537 @@
 import csv
+import gzip
+import io
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from tempfile import TemporaryDirectory
 
 from airflow.utils.decorators import apply_defaults
 from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
 from airflow.exceptions import AirflowException
+from snowflake.connector.errors import NotSupportedError, ProgrammingError
+
+try:
+    from snowflake.connector.result_batch import ArrowResultBatch
+except ImportError:
+    # connectors before 2.5 can't hand out their result batches
+    ArrowResultBatch = None
+
+
+def _quote_identifier(name):
+    """
+    Quote an identifier for Snowflake, doubling any double quotes in it.
+    """
+    return '"' + name.replace('"', '""') + '"'
 
 
 class ExtendedSnowflakeHook(SnowflakeHook): 
     """
     This class extends the SnowflakeHook to provide additional functionality.
     """
+    # idle connections, shared by every hook in the process and keyed by _pool_key
+    _pools = {}
+    _pools_lock = threading.Lock()
+
     @apply_defaults
-    def __init__(self, snowflake_conn_id='snowflake_default', *args, **kwargs) -> None:
+    def __init__(self, snowflake_conn_id='snowflake_default', pool_size: int=4, pool_recycle: int=300, fetch_parallelism: int=4, *args, **kwargs) -> None:
         """
         Initialize a new instance of ExtendedSnowflakeHook.
 
         :param snowflake_conn_id: The ID of the connection to use.
+        :param pool_size: The number of idle connections kept open for this
+            connection ID and session settings. Operators close them with
+            close_pool when they finish.
+        :param pool_recycle: Idle connections older than this many seconds are
+            closed instead of being reused.
+        :param fetch_parallelism: The number of Arrow result batches arrow_batches
+            downloads and decodes at the same time. Set to 1 to fetch them one by one.
         """
         super().__init__(*args, **kwargs)
 
         self.snowflake_conn_id = snowflake_conn_id
+        self.pool_size = pool_size
+        self.pool_recycle = pool_recycle
+        self.fetch_parallelism = fetch_parallelism
+        # result column names keyed by query, filled in by _result_columns
+        self._result_columns_cache = {}
+
+    @classmethod
+    def close_pools(cls):
+        """
+        Close every idle pooled connection.
+        """
+        with cls._pools_lock:
+            pools = list(cls._pools.values())
+            cls._pools.clear()
+
+        for pool in pools:
+            cls._close_idle_connections(pool)
+
+    @staticmethod
+    def _close_idle_connections(pool):
+        while True:
+            try:
+                conn, _ = pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+    def close_pool(self):
+        """
+        Close the idle connections pooled for this hook's connection ID and
+        session settings. Connections still in use are closed when they're
+        released.
+        """
+        with self._pools_lock:
+            pool = self._pools.pop(self._pool_key, None)
+
+        if pool is not None:
+            self._close_idle_connections(pool)
+
+    @property
+    def _pool_key(self):
+        # hooks that override the connection's session settings can't share its sessions
+        return (
+            self.snowflake_conn_id,
+            getattr(self, 'warehouse', None),
+            getattr(self, 'database', None),
+            getattr(self, 'role', None),
+            getattr(self, 'schema', None),
+            getattr(self, 'authenticator', None),
+            repr(getattr(self, 'session_parameters', None)),
+        )
+
+    def _get_pool(self):
+        key = self._pool_key
+        with self._pools_lock:
+            if key not in self._pools:
+                self._pools[key] = queue.LifoQueue(maxsize=self.pool_size)
+            return self._pools[key]
+
+    def _release_connection(self, pool, conn):
+        if conn.is_closed():
+            return
+
+        with self._pools_lock:
+            # the pool may have been closed while the connection was in use
+            if self._pools.get(self._pool_key) is pool:
+                try:
+                    pool.put_nowait((conn, time.monotonic()))
+                    return
+                except queue.Full:
+                    pass
+
+        conn.close()
+
+    @contextmanager
+    def _connection(self):
+        """
+        Reuse an idle connection left by an earlier query, opening a new one with
+        get_conn if there is none, so each query doesn't log in to Snowflake again.
+        The connection is returned to the pool when the block exits.
+        """
+        pool = self._get_pool()
+        conn = None
+
+        while conn is None:
+            try:
+                conn, released_at = pool.get_nowait()
+            except queue.Empty:
+                conn = self.get_conn()
+                break
+            if conn.is_closed() or time.monotonic() - released_at > self.pool_recycle:
+                conn.close()
+                conn = None
+
+        try:
+            yield conn
+        finally:
+            self._release_connection(pool, conn)
     
+    def _validate_destination_type(self, destination_type):
+        if destination_type not in ['snowflake', 'postgres']:
+            raise AirflowException(f'destination_type must be one of ["snowflake", "postgres"], not {destination_type}')
+
+    def _array_fields_query(self, query, array_fields):
+        """
+        Wrap a query so that Snowflake renders the array fields as Postgres array literals.
+        Array fields that aren't result columns are ignored, which needs one extra
+        query that returns no rows to read the result's columns. That is only run
+        the first time a query is wrapped by this hook.
+
+        :param query: The SQL query to wrap.
+        :param array_fields: The fields to treat as arrays.
+        :return: The wrapped query, or the original query if there are no array fields.
+        """
+        if not array_fields:
+            return query
+
+        result_columns = set(self._result_columns(query))
+        missing_fields = [field for field in array_fields if field not in result_columns]
+        if missing_fields:
+            self.log.warning(f'Ignoring array fields that are not result columns: {missing_fields}')
+        array_fields = [field for field in array_fields if field in result_columns]
+        if not array_fields:
+            return query
+
+        replacements = []
+        for field in array_fields:
+            quoted = _quote_identifier(field)
+            value = f'{quoted}::varchar'
+            replacements.append(f"'{{' || substr({value}, 2, length({value}) - 2) || '}}' as {quoted}")
+
+        return f'select * replace ({", ".join(replacements)}) from ({query})'
+
+    def _result_columns(self, query):
+        """
+        Return the column names of a query's result, without fetching any rows. They
+        are looked up once per query and kept on the hook.
+
+        :param query: The SQL query.
+        """
+        if query not in self._result_columns_cache:
+            with self._connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'select * from ({query}) limit 0')
+                self._result_columns_cache[query] = [desc[0] for desc in cursor.description]
+
+        return self._result_columns_cache[query]
+
     def generate_rows_from_table(self, query, chunk_size=1000):
         """
-        Generate rows from a table in chunks.
+        Generate rows from a table in chunks, as dicts keyed by column name.
+
+        Deprecated: use generate_tuples_from_table, which yields each fetched chunk
+        as it comes from the cursor instead of building a dict per row.
 
         :param query: The SQL query to execute.
         :param chunk_size: The number of rows to fetch at a time.
         """
-        conn = self.get_conn()
-        cursor = conn.cursor()
+        warnings.warn(
+            'generate_rows_from_table is deprecated, use generate_tuples_from_table instead',
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        row_dict = None
 
-        cursor.execute(query)
-
-        # Get column names once
-        column_names = [desc[0] for desc in cursor.description]
-        # Create a dictionary with column names as keys and None as values
-        row_dict = dict.fromkeys(column_names)
-
-        while True:
-            rows = cursor.fetchmany(chunk_size)
-            if not rows:
-                break
+        for rows, column_names in self.generate_tuples_from_table(query, chunk_size):
+            if row_dict is None:
+                # Create a dictionary with column names as keys and None as values
+                row_dict = dict.fromkeys(column_names)
 
             for row in rows:
                 # Update values of row_dict for each row
                 row_dict.update(zip(column_names, row))
                 yield row_dict, column_names
-    
+
+    def generate_tuples_from_table(self, query, chunk_size=10000):
+        """
+        Generate rows from a table in chunks, as the tuples returned by the cursor.
+
+        :param query: The SQL query to execute.
+        :param chunk_size: The number of rows to fetch at a time.
+        :return: A generator of (rows, column_names) pairs, one per fetched chunk.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            # the connector fetches arraysize rows per round trip
+            cursor.arraysize = chunk_size
+
+            cursor.execute(query)
+            column_names = [desc[0] for desc in cursor.description]
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows, column_names
+
+    def generate_dataframes_from_table(self, query, chunk_size=10000, use_arrow=False):
+        """
+        Generate the results of a query as pandas DataFrames.
+
+        By default each DataFrame holds chunk_size rows fetched from the cursor, in
+        columns of object dtype, so every value is the one the cursor returned:
+        integers stay integers even next to nulls, and NUMBER columns with a scale
+        stay Decimals.
+
+        With use_arrow, the DataFrames are built from the Arrow result batches
+        returned by Snowflake instead, when the connector supports it. That's faster
+        but the values are pandas types: integer columns use the nullable Int64
+        dtypes, NUMBER columns with a scale come back as floats and timestamps as
+        pandas Timestamps. Arrow batches are sized by Snowflake, so they may not
+        have exactly chunk_size rows.
+
+        :param query: The SQL query to execute.
+        :param chunk_size: The number of rows to fetch at a time.
+        :param use_arrow: Whether to build the DataFrames from Arrow result batches.
+        """
+        import pandas as pd
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.arraysize = chunk_size
+
+            cursor.execute(query)
+
+            if use_arrow:
+                try:
+                    import pyarrow as pa
+
+                    # keep integer columns with nulls as integers instead of floats
+                    nullable_types = {
+                        pa.int8(): pd.Int8Dtype(),
+                        pa.int16(): pd.Int16Dtype(),
+                        pa.int32(): pd.Int32Dtype(),
+                        pa.int64(): pd.Int64Dtype(),
+                    }
+                    batches = iter(cursor.fetch_pandas_batches(types_mapper=nullable_types.get))
+                    first_batch = next(batches, None)
+                except (ImportError, NotSupportedError, ProgrammingError):
+                    # the pandas extras aren't installed, or the result isn't in Arrow format
+                    self.log.info('Arrow result batches are not available, fetching rows instead')
+                else:
+                    if first_batch is not None and len(first_batch):
+                        yield first_batch
+                    for batch in batches:
+                        if len(batch):
+                            yield batch
+                    return
+
+            column_names = [desc[0] for desc in cursor.description]
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=column_names, dtype=object)
+
+    def iter_rows(self, query, array_fields, destination_type='snowflake', chunk_size=10000):
+        """
+        Generate the results of a query in chunks of rows, ready to load into the
+        destination. For Postgres, the array fields are rendered as Postgres array
+        literals by Snowflake.
+
+        :param query: The SQL query to execute.
+        :param array_fields: The fields to treat as arrays.
+        :param destination_type: The type of the destination database.
+        :param chunk_size: The number of rows to fetch at a time.
+        """
+        self._validate_destination_type(destination_type)
+
+        if destination_type == 'postgres':
+            query = self._array_fields_query(query, array_fields)
+
+        for rows, _ in self.generate_tuples_from_table(query, chunk_size):
+            yield rows
+
+    def _execute_and_fetch(self, query, chunk_size):
+        """
+        Run a query, then generate its cursor followed by chunks of its rows. The
+        connection is leased until the generator is exhausted or closed.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.arraysize = chunk_size
+
+            cursor.execute(query)
+            yield cursor
+
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+
+    def fetch_all_if_small(self, query, array_fields, max_rows, destination_type='snowflake', chunk_size=10000):
+        """
+        Run a query and fetch all of its rows if there are at most max_rows of them.
+
+        The row count is read from the cursor after the query runs, before any
+        rows are fetched. Larger results are streamed from the same cursor
+        instead, so the query only runs once either way.
+
+        :param query: The SQL query to execute.
+        :param array_fields: The fields to treat as arrays.
+        :param max_rows: The largest number of rows to fetch at once.
+        :param destination_type: The type of the destination database.
+        :param chunk_size: The number of rows to fetch at a time.
+        :return: A (rows, row_chunks) pair. If the result is small, rows is all of
+            it and row_chunks is None. Otherwise rows is None and row_chunks
+            generates the result in chunks; close it if it isn't exhausted, to
+            release the connection.
+        """
+        self._validate_destination_type(destination_type)
+
+        if destination_type == 'postgres':
+            query = self._array_fields_query(query, array_fields)
+
+        row_chunks = self._execute_and_fetch(query, chunk_size)
+        rowcount = next(row_chunks).rowcount
+        if rowcount is None or rowcount < 0 or rowcount > max_rows:
+            return None, row_chunks
+
+        self.log.info(f'Query returned {rowcount} rows, fetching them all')
+        return [row for rows in row_chunks for row in rows], None
+
+    def arrow_batches(self, query):
+        """
+        Generate the results of a query as Arrow tables, straight from the
+        columnar result set returned by Snowflake. The result batches are
+        independent files, so up to fetch_parallelism of them are downloaded and
+        decoded at once by worker threads; they are still generated in order.
+
+        :param query: The SQL query to execute.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(query)
+            result_batches = cursor.get_result_batches() if ArrowResultBatch is not None else None
+            if self.fetch_parallelism <= 1 or not result_batches or not all(isinstance(batch, ArrowResultBatch) for batch in result_batches):
+                yield from cursor.fetch_arrow_batches()
+                return
+
+            with ThreadPoolExecutor(max_workers=self.fetch_parallelism) as executor:
+                pending = deque()
+                for batch in result_batches:
+                    pending.append(executor.submit(batch.to_arrow))
+                    # keep a bounded number of decoded batches in memory
+                    if len(pending) >= self.fetch_parallelism:
+                        yield pending.popleft().result()
+
+                while pending:
+                    yield pending.popleft().result()
+
+    def _save_arrow_batches_to_tmp_file(self, query, file):
+        import pyarrow.csv as pa_csv
+
+        headers_written = False
+
+        for batch in self.arrow_batches(query):
+            if batch.num_rows == 0:
+                continue
+
+            sink = io.BytesIO()
+            write_options = pa_csv.WriteOptions(include_header=not headers_written, delimiter='|')
+            pa_csv.write_csv(batch, sink, write_options=write_options)
+            file.write(sink.getvalue().decode('utf-8'))
+            headers_written = True
+
+        return headers_written
+
+    def _save_rows_to_tmp_file(self, query, file):
+        writer = csv.writer(file, delimiter='|', quotechar='"')
+        headers_written = False
+
+        for rows, column_names in self.generate_tuples_from_table(query):
+            if not headers_written:
+                writer.writerow(column_names)
+                headers_written = True
+
+            writer.writerows(rows)
+
+        return headers_written
+
     def save_snowflake_results_to_tmp_file(self, query, array_fields, file, destination_type='snowflake'):
         """
         Save the results of a Snowflake query to a temporary file.
 
+        The results are fetched as Arrow batches and written with pyarrow's CSV
+        writer when pyarrow is installed, otherwise they are written row by row.
+        Array fields are converted to Postgres array literals in Snowflake, so the
+        rows are written as they are fetched.
+
         :param query: The SQL query to execute.
         :param array_fields: The fields to treat as arrays.
         :param file: The file to write the results to.
         :param destination_type: The type of the destination database.
+        :return: Whether the query returned any rows.
         """
-        if destination_type not in ['snowflake', 'postgres']:
-            raise AirflowException(f'destination_type must be one of ["snowflake", "postgres"], not {destination_type}')
+        self._validate_destination_type(destination_type)
+
+        if destination_type == 'postgres':
+            query = self._array_fields_query(query, array_fields)
 
         self.log.info('START save_snowflake_results_to_tmp_file')
         self.log.info(f'Query: {query}')
 
-        rows_generator = self.generate_rows_from_table(query)
-        headers_written = False
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            self.log.info('pyarrow is not installed, writing results row by row')
+            return self._save_rows_to_tmp_file(query, file)
 
-        writer = None
+        return self._save_arrow_batches_to_tmp_file(query, file)
 
-        for row, headers in rows_generator:
-            if not headers_written:
-                writer = csv.DictWriter(file, fieldnames=headers, delimiter='|', quotechar='"')
-                writer.writeheader()
-                headers_written = True
+    def save_via_stage(self, query, array_fields, file, destination_type='snowflake'):
+        """
+        Save the results of a Snowflake query to a temporary file by unloading them
+        through the user stage.
+
+        Snowflake writes gzipped CSV files server-side with COPY INTO, which are then
+        downloaded with GET and decompressed into the file. Array fields are converted
+        to Postgres array literals in Snowflake. If the query can't be unloaded, this
+        falls back to save_snowflake_results_to_tmp_file.
+
+        :param query: The SQL query to execute.
+        :param array_fields: The fields to treat as arrays.
+        :param file: The file to write the results to.
+        :param destination_type: The type of the destination database.
+        :return: Whether the query returned any rows.
+        """
+        self._validate_destination_type(destination_type)
+
+        self.log.info('START save_via_stage')
+        self.log.info(f'Query: {query}')
+
+        stage_path = f'@~/airflow_tmp/{uuid.uuid4().hex}/'
+        export_query = self._array_fields_query(query, array_fields) if destination_type == 'postgres' else query
+        # COPY's CSV format has no escape character outside quotes, and the session's
+        # default output formats drop everything past milliseconds
+        copy_sql = f"""
+            copy into {stage_path}
+            from ({export_query})
+            file_format=(type=csv field_delimiter='|' field_optionally_enclosed_by='"' escape_unenclosed_field=none compression=gzip null_if=('')
+                         date_format='YYYY-MM-DD' time_format='HH24:MI:SS.FF6' timestamp_format='YYYY-MM-DD HH24:MI:SS.FF6 TZH:TZM')
+            header=true overwrite=true max_file_size=209715200 single=false
+        """
+
+        with self._connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                try:
+                    cursor.execute(copy_sql)
+                except ProgrammingError as e:
+                    self.log.warning(f'Query could not be unloaded to a stage, falling back to a row export: {e}')
+                    return self.save_snowflake_results_to_tmp_file(query, array_fields, file, destination_type)
 
-            if destination_type == 'postgres':
-                for key, value in row.items():
-                    if key in array_fields:
-                        row[key] = '{' + str(value)[1:-1] + '}'
+                rows_unloaded = sum(row[0] for row in cursor.fetchall())
+                self.log.info(f'Unloaded {rows_unloaded} rows to {stage_path}')
+                if rows_unloaded == 0:
+                    return False
 
-            writer.writerow(row)
+                with TemporaryDirectory() as tmp_dir:
+                    cursor.execute(f"get {stage_path} 'file://{tmp_dir}/'")
 
-        if not headers_written:
-            return False
+                    headers_written = False
+                    for file_name in sorted(os.listdir(tmp_dir)):
+                        with gzip.open(os.path.join(tmp_dir, file_name), 'rt', newline='') as part:
+                            # every unloaded file has its own header row
+                            header = part.readline()
+                            if not headers_written:
+                                file.write(header)
+                                headers_written = True
+                            shutil.copyfileobj(part, file)
 
-        return True
+                return True
+            finally:
+                cursor.execute(f'remove {stage_path}')
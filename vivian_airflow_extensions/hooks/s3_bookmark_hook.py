@@ -1,9 +1,29 @@
-import s3fs
+import functools
+
+import boto3
+from botocore.exceptions import ClientError
 from airflow.hooks.base import BaseHook
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
 
+@functools.lru_cache(maxsize=None)
+def _s3_client():
+    """
+    Return a boto3 S3 client shared by every bookmark hook in the process, so
+    credentials are only resolved once.
+    """
+    return boto3.client('s3')
+
+
+def _parse_s3_url(s3_url):
+    """
+    Split an S3 url of the form s3://bucket/key into its bucket and key.
+    """
+    bucket, _, key = s3_url.replace('s3://', '', 1).partition('/')
+    return bucket, key
+
+
 class S3BookmarkHook(BaseHook):
     """
     This class interacts with S3 to get and save bookmarks.
@@ -27,7 +47,8 @@ class S3BookmarkHook(BaseHook):
             raise AirflowException('incremental_key_type is required')
         
         self.bookmark_s3_key = bookmark_s3_key
-        self.incremental_key_type = incremental_key_type   
+        self.incremental_key_type = incremental_key_type
+        self.bucket, self.key = _parse_s3_url(bookmark_s3_key)
 
     def get_latest_bookmark(self):
         """
@@ -35,15 +56,15 @@ class S3BookmarkHook(BaseHook):
 
         :return: The latest bookmark.
         """
-        s3 = s3fs.S3FileSystem(anon=False)
-
         try:
-            with s3.open(self.bookmark_s3_key, 'r') as f:
-                key = f.read().strip()
+            response = _s3_client().get_object(Bucket=self.bucket, Key=self.key)
+            key = response['Body'].read().decode('utf-8').strip()
             if self.incremental_key_type == 'timestamp':
                 key = f"'{key}'" 
             self.log.info(f'Read {key} as the latest bookmark from {self.bookmark_s3_key}')
-        except FileNotFoundError:
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchKey':
+                raise
             if self.incremental_key_type == 'int':
                 key = 0
             elif self.incremental_key_type == 'timestamp':
@@ -52,6 +73,20 @@ class S3BookmarkHook(BaseHook):
 
         return key  
 
+    def format_bookmark(self, bookmark):
+        """
+        Format a bookmark the way it's saved to S3. Dates and timestamps are written
+        with format_string, keeping their wall-clock time: an aware timestamp is not
+        converted to UTC, since the saved text is read back in the Snowflake session
+        timezone. Other values, like int keys, are written as they are.
+
+        :param bookmark: The bookmark to format.
+        :return: The formatted bookmark.
+        """
+        if hasattr(bookmark, 'strftime'):
+            return bookmark.strftime(self.format_string)
+        return str(bookmark)
+
     def save_next_bookmark(self, bookmark):
         """
         Save the next bookmark to S3.
@@ -62,10 +97,7 @@ class S3BookmarkHook(BaseHook):
             self.log.info('Bookmark is None, not saving it')
             return
         else:
-            bookmark = bookmark.strftime(self.format_string)
-
-        s3 = s3fs.S3FileSystem(anon=False)
+            bookmark = self.format_bookmark(bookmark)
 
-        with s3.open(self.bookmark_s3_key, 'w') as f:
-            f.write(bookmark)
+        _s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=bookmark.encode('utf-8'))
         self.log.info(f'Wrote {bookmark} as latest bookmark to {self.bookmark_s3_key}')
@@ -10,13 +10,23 @@ from airflow.hooks.base import BaseHook
 
 class StitchHook(BaseHook):
     @apply_defaults
-    def __init__(self, conn_id: str, *args, **kwargs) -> None:
+    def __init__(self, conn_id: str, poll_interval: int = 30, credentials_ttl: int = 3600, *args, **kwargs) -> None:
+        """
+        :param conn_id: the Stitch connection id
+        :param poll_interval: seconds to wait before the first extraction status check; later checks
+            back off exponentially from it
+        :param credentials_ttl: seconds to reuse the connection's host and headers before looking
+            the connection up again
+        """
         super().__init__(*args, **kwargs)
 
         if conn_id is None:
             raise AirflowException('conn_id is required')
         
         self.conn_id = conn_id
+        self.poll_interval = poll_interval
+        self.credentials_ttl = credentials_ttl
+        self._credentials_expire_at = None
 
     def _get_response(self, url: str, method: str) -> dict:
         response = requests.request(method, url, headers=self.headers)
@@ -27,9 +37,17 @@ class StitchHook(BaseHook):
         return dict_data
     
     def get_credentials(self) -> None:
+        """
+        Load the host and headers from the connection, unless they were loaded less than
+        credentials_ttl seconds ago.
+        """
+        if self._credentials_expire_at is not None and time.monotonic() < self._credentials_expire_at:
+            return
+
         conn = self.get_connection(conn_id=self.conn_id)
         self.host = conn.host
         self.headers = conn.extra_dejson
+        self._credentials_expire_at = time.monotonic() + self.credentials_ttl
     
     def trigger_extraction(self, source_id: str, client_id: str) -> dict:
         self.get_credentials()
@@ -47,36 +65,76 @@ class StitchHook(BaseHook):
         else:
             self.log.info(f'Extraction triggered: source_id = {source_id}, job_name = {job_name}, integration url = https://app.stitchdata.com/client/{client_id}/pipeline/v2/sources/{source_id}/')
 
-    def monitor_extraction(self, source_id: str, client_id: str, sleep_time=300, timeout=86400, start_time: datetime=datetime.now()) -> None:
-        time.sleep(30) # let the job actually trigger
+    def get_last_extraction(self, source_id: str, client_id: str) -> dict:
+        """
+        Return the status object of the source's last extraction, following the pages of the
+        extractions endpoint until it is found.
+        """
         url = (f'{self.host}/{client_id}/extractions')
-        id_found = False
 
-        while (datetime.now() - start_time).seconds < timeout:
+        while True:
             dict_data = self._get_response(url, 'GET')
 
             for item in dict_data['data']:
                 if str(item['source_id']) == source_id:
                     self.log.info(f'Extraction status object: {item}')
-                    id_found = True
-                    last_extraction_completion_time = datetime.strptime(item['completion_time'],'%Y-%m-%dT%H:%M:%SZ')
-
-                    if last_extraction_completion_time < start_time:
-                        self.log.info(f'Waiting for all extractions to complete: source_id = {source_id}')
-                        time.sleep(sleep_time)
-                        url = (f'{self.host}/{client_id}/extractions')   
-                    elif item['tap_exit_status'] != 0 and item['tap_exit_status'] is not None:
-                        raise AirflowException(f'Error: source_id = {source_id} extraction failed')
-                    else:
-                        exec_time = (datetime.now() - start_time).seconds
-                        self.log.info(f'Extraction succeeded in {exec_time} seconds')
-                        return 
-                    break
-
-            if 'next' in dict_data['links'] and not id_found:
-                next = dict_data['links']['next']
-                url = (f'https://api.stitchdata.com{next}')
-            elif not id_found:
+                    return item
+
+            if 'next' not in dict_data['links']:
                 raise AirflowException(f'Error: source_id = {source_id} not found in response')
-        
+
+            next = dict_data['links']['next']
+            url = (f'https://api.stitchdata.com{next}')
+
+    def extraction_succeeded(self, source_id: str, client_id: str, start_time: datetime) -> bool:
+        """
+        Check once whether the source's last extraction completed after start_time, without
+        waiting. Raises if it completed but failed.
+        """
+        return self._extraction_succeeded(source_id, self.get_last_extraction(source_id, client_id), start_time)
+
+    @staticmethod
+    def _completion_time(item: dict) -> datetime:
+        return datetime.strptime(item['completion_time'], '%Y-%m-%dT%H:%M:%SZ')
+
+    def _extraction_succeeded(self, source_id: str, item: dict, start_time: datetime) -> bool:
+        if self._completion_time(item) < start_time:
+            return False
+        if item['tap_exit_status'] != 0 and item['tap_exit_status'] is not None:
+            raise AirflowException(f'Error: source_id = {source_id} extraction failed')
+        return True
+
+    def monitor_extraction(self, source_id: str, client_id: str, sleep_time=300, timeout=86400, start_time: datetime=None) -> None:
+        """
+        Poll the extractions endpoint until the source's last extraction completes after start_time
+        (defaults to now). The wait between polls doubles from poll_interval up to sleep_time, and
+        starts over whenever the extraction's completion time moves. Gives up timeout seconds after
+        the call.
+        """
+        if start_time is None:
+            start_time = datetime.now()
+        deadline = time.monotonic() + timeout
+
+        time.sleep(self.poll_interval) # let the job actually trigger
+        attempt = 0
+        last_completion_time = None
+
+        while time.monotonic() < deadline:
+            item = self.get_last_extraction(source_id, client_id)
+
+            if self._extraction_succeeded(source_id, item, start_time):
+                exec_time = int((datetime.now() - start_time).total_seconds())
+                self.log.info(f'Extraction succeeded in {exec_time} seconds')
+                return
+
+            completion_time = self._completion_time(item)
+            if completion_time != last_completion_time:
+                attempt = 0
+                last_completion_time = completion_time
+
+            delay = min(sleep_time, self.poll_interval * 2 ** attempt)
+            attempt += 1
+            self.log.info(f'Waiting {delay} seconds for all extractions to complete: source_id = {source_id}')
+            time.sleep(delay)
+
         raise AirflowException(f'Error: source_id = {source_id} timed out')
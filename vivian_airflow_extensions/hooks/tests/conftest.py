@@ -0,0 +1,69 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+
+from vivian_airflow_extensions.hooks.stitch_hook import StitchHook
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    """
+    Replace time.sleep with a mock for every hook test, so polling and retry
+    loops run straight through. Tests can inspect or drive it through this fixture.
+    """
+    sleep = MagicMock()
+    monkeypatch.setattr('time.sleep', sleep)
+    return sleep
+
+
+@pytest.fixture
+def pg_conn():
+    """
+    A mock psycopg2 connection, returned by every PostgresHook.get_conn call made
+    during the test.
+    """
+    conn = MagicMock()
+    conn.closed = 0
+    # psycopg2 connections have no pipeline mode
+    del conn.pipeline
+
+    with patch.object(PostgresHook, 'get_conn', return_value=conn):
+        yield conn
+
+
+@pytest.fixture
+def snowflake_cursor():
+    """
+    The cursor of a mock Snowflake connection, returned by every
+    SnowflakeHook.get_conn call made during the test. It returns a single row of
+    two columns.
+    """
+    conn = MagicMock()
+    conn.is_closed.return_value = False
+    cursor = conn.cursor.return_value
+    cursor.description = [('column1',), ('column2',)]
+    cursor.rowcount = 1
+    cursor.fetchall.return_value = [('value1', 'value2')]
+
+    def execute(*args, **kwargs):
+        # every query starts a new result
+        cursor.fetchmany.side_effect = [[('value1', 'value2')], []]
+
+    cursor.execute.side_effect = execute
+
+    with patch.object(SnowflakeHook, 'get_conn', return_value=conn):
+        yield cursor
+
+
+@pytest.fixture
+def stitch_hook():
+    """
+    A StitchHook that doesn't look up its connection. Its _get_response is a mock
+    for the test to configure.
+    """
+    with patch.object(StitchHook, 'get_credentials'), patch.object(StitchHook, '_get_response'):
+        hook = StitchHook(conn_id='test_conn_id', poll_interval=0)
+        hook.host = 'test_host'
+        yield hook
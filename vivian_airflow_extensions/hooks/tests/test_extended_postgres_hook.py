@@ -1,113 +1,296 @@
-import unittest
-from unittest.mock import patch, MagicMock
+import struct
+from unittest.mock import patch, MagicMock, ANY
 
+import pytest
+from airflow.exceptions import AirflowException
 from airflow.providers.postgres.hooks.postgres import PostgresHook
 
-from vivian_airflow_extensions.hooks.extended_postgres_hook import ExtendedPostgresHook
+from vivian_airflow_extensions.hooks.extended_postgres_hook import ExtendedPostgresHook, PG_BINARY_COPY_HEADER, PG_BINARY_COPY_TRAILER, _encode_numeric
 
-class TestExtendedPostgresHook(unittest.TestCase):
-    def test_init(self):
-        hook = ExtendedPostgresHook(postgres_conn_id='test_conn_id')
-        self.assertEqual(hook.postgres_conn_id, 'test_conn_id')
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_run_psql_commands_in_transaction(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
+@pytest.fixture(autouse=True)
+def reset_hook_state():
+    yield
+    ExtendedPostgresHook.close_pools()
+    ExtendedPostgresHook.clear_metadata_cache()
 
-        hook = ExtendedPostgresHook()
-        hook._run_psql_commands_in_transaction(['SELECT 1'])
 
-        mock_conn.cursor().execute.assert_called_once_with('SELECT 1')
-        mock_conn.commit.assert_called_once()
-        mock_conn.close.assert_called_once()
+def test_init():
+    hook = ExtendedPostgresHook(postgres_conn_id='test_conn_id')
+    assert hook.postgres_conn_id == 'test_conn_id'
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_get_table_metadata(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
-        mock_conn.cursor().fetchall.side_effect = [[('id', 'integer', 'nextval')], [], []]
 
-        hook = ExtendedPostgresHook()
-        columns = hook.get_table_metadata('test_table')
+def test_run_psql_commands_in_transaction(pg_conn):
+    hook = ExtendedPostgresHook()
+    hook._run_psql_commands_in_transaction(['SELECT 1', 'SELECT 2;'])
 
-        self.assertEqual(columns, [])
-        self.assertEqual(hook.serial_columns, ['id'])
+    pg_conn.cursor().execute.assert_called_once_with('SELECT 1;\nSELECT 2;')
+    pg_conn.commit.assert_called_once()
+    pg_conn.close.assert_not_called()
+    assert hook._get_pool()[0].get_nowait()[0] is pg_conn
 
-    @patch.object(ExtendedPostgresHook, '_run_psql_commands_in_transaction')
-    def test_create_tmp_table(self, mock_run_psql_commands_in_transaction):
-        hook = ExtendedPostgresHook()
-        hook.serial_columns = ['id']
-        hook.constraints = [('test_constraint', 'test_def', 'f')]
 
-        hook.create_tmp_table('test_table')
+@patch.object(PostgresHook, 'get_conn')
+def test_run_psql_commands_in_transaction_pipeline(mock_get_conn):
+    mock_conn = MagicMock()
+    mock_get_conn.return_value = mock_conn
 
-        mock_run_psql_commands_in_transaction.assert_called_once()
+    hook = ExtendedPostgresHook()
+    hook._run_psql_commands_in_transaction(['SELECT 1', 'SELECT 2;'])
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_write_to_db(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
+    mock_conn.pipeline.assert_called_once()
+    assert [c[0][0] for c in mock_conn.cursor().execute.call_args_list] == ['SELECT 1', 'SELECT 2;']
+    mock_conn.commit.assert_called_once()
 
-        hook = ExtendedPostgresHook()
-        hook.write_to_db(MagicMock(), 'id', 'test_table')
 
-        mock_conn.cursor().copy_expert.assert_called_once()
-        mock_conn.commit.assert_called_once()
-        mock_conn.close.assert_called_once()
+def test_connection_reused(pg_conn):
+    hook = ExtendedPostgresHook()
+    hook._run_psql_commands_in_transaction(['SELECT 1'])
+    hook._run_psql_commands_in_transaction(['SELECT 2'])
 
-    @patch.object(ExtendedPostgresHook, '_run_psql_commands_in_transaction')
-    def test_swap_db_tables(self, mock_run_psql_commands_in_transaction):
-        hook = ExtendedPostgresHook()
-        hook.serial_columns = ['id']
-        hook.constraints = [('test_constraint', 'test_def', 'f')]
-        hook.indexes = ['test_index']
+    PostgresHook.get_conn.assert_called_once()
 
-        hook.swap_db_tables('test_table')
 
-        mock_run_psql_commands_in_transaction.assert_called_once()
+def test_close_pool(pg_conn):
+    hook = ExtendedPostgresHook()
+    hook._run_psql_commands_in_transaction(['SELECT 1'])
+    pg_conn.close.assert_not_called()
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_run_psql_commands_in_transaction_error(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
-        mock_conn.cursor().execute.side_effect = Exception('Test exception')
+    hook.close_pool()
 
-        hook = ExtendedPostgresHook()
+    pg_conn.close.assert_called_once()
+    assert not ExtendedPostgresHook._pools
 
-        with self.assertRaises(Exception) as context:
-            hook._run_psql_commands_in_transaction(['SELECT 1'])
 
-        self.assertTrue('Test exception' in str(context.exception))
-        mock_conn.rollback.assert_called_once()
-        mock_conn.close.assert_called_once()
+def test_close_pool_while_leased(pg_conn):
+    hook = ExtendedPostgresHook()
+    with hook._connection():
+        hook.close_pool()
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_get_table_metadata_error(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
-        mock_conn.cursor().execute.side_effect = Exception('Test exception')
+    # released into a pool that's gone, so it's closed instead
+    pg_conn.close.assert_called_once()
 
-        hook = ExtendedPostgresHook()
 
-        with self.assertRaises(Exception) as context:
-            hook.get_table_metadata('test_table')
+def test_get_table_metadata(pg_conn):
+    pg_conn.cursor().fetchall.return_value = [
+        ('cols', 1, 'id', 'integer', "nextval('test_table_id_seq'::regclass)", None, None, None, None),
+        ('cols', 2, 'name', 'text', None, None, None, None, None),
+        ('cons', 0, 'test_table_pkey', 'PRIMARY KEY (id)', 'p', None, None, None, None),
+        ('idx', 0, 'test_table_pkey', 'CREATE UNIQUE INDEX test_table_pkey ON public.test_table USING btree (id)', None, None, None, None, None),
+        ('seq', 1, 'id', 'test_table_id_seq', '1', '1', '2147483647', None, 'false'),
+    ]
 
-        self.assertTrue('Test exception' in str(context.exception))
-        mock_conn.close.assert_called_once()
+    hook = ExtendedPostgresHook()
+    columns = hook.get_table_metadata('test_table', 'public', False)
 
-    @patch.object(PostgresHook, 'get_conn')
-    def test_write_to_db_error(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
-        mock_conn.cursor().copy_expert.side_effect = Exception('Test exception')
+    pg_conn.cursor().execute.assert_called_once()
+    assert columns == ['name']
+    assert hook.constraints == [{'name': 'test_table_pkey', 'definition': 'PRIMARY KEY (id)', 'type': 'p'}]
+    assert hook.indexes == []
+    assert hook.sequences == [{
+        'name': 'test_table_id_seq',
+        'column': 'id',
+        'increment': 1,
+        'minvalue': 1,
+        'maxvalue': 2147483647,
+        'last': 1,
+        'cycle': '',
+    }]
 
-        hook = ExtendedPostgresHook()
 
-        with self.assertRaises(Exception) as context:
-            hook.write_to_db(MagicMock(), 'id', 'test_table')
+def test_get_table_metadata_cached(pg_conn):
+    pg_conn.cursor().fetchall.return_value = [
+        ('cols', 1, 'id', 'integer', "nextval('test_table_id_seq'::regclass)", None, None, None, None),
+        ('cols', 2, 'name', 'text', None, None, None, None, None),
+        ('seq', 1, 'id', 'test_table_id_seq', '1', '1', '2147483647', '10', 'false'),
+    ]
 
-        self.assertTrue('Test exception' in str(context.exception))
+    ExtendedPostgresHook().get_table_metadata('test_table', 'public', False)
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    pg_conn.cursor().execute.reset_mock()
+    pg_conn.cursor().fetchall.return_value = [('test_table_id_seq', 25)]
+
+    hook = ExtendedPostgresHook()
+    columns = hook.get_table_metadata('test_table', 'public', False)
+
+    # only the sequence values are read again
+    pg_conn.cursor().execute.assert_called_once_with(ANY, {'schema': 'public', 'names': ['test_table_id_seq']})
+    assert columns == ['name']
+    assert hook.sequences[0]['last'] == 25
+
+
+@patch.object(ExtendedPostgresHook, '_generate_drop_table_attributes_commands')
+@patch.object(ExtendedPostgresHook, '_run_psql_commands_in_transaction')
+def test_create_tmp_table(mock_run_psql_commands_in_transaction, mock_generate_drop_table_attributes_commands):
+    hook = ExtendedPostgresHook()
+    hook.sequences = [{'name': 'test_seq', 'column': 'id', 'increment': 1, 'minvalue': 1, 'maxvalue': 100, 'last': 5, 'cycle': ''}]
+    hook.constraints = [{'name': 'test_constraint', 'definition': 'test_def', 'type': 'f'}]
+
+    hook.create_tmp_table('test_table')
+
+    mock_run_psql_commands_in_transaction.assert_called_once()
+    commands = mock_run_psql_commands_in_transaction.call_args[0][0]
+    assert 'create table "Tmptest_table" (like "test_table" including all excluding indexes excluding constraints);' in commands
+    assert 'alter table "Tmptest_table" alter column "id" set default nextval(\'"Tmptest_seq"\');' in commands
+    # constraints are only added back to the real table, after the load
+    assert not any('add constraint' in command for command in commands)
+    mock_generate_drop_table_attributes_commands.assert_called_once_with('Tmptest_table')
+
+
+def test_write_to_db(pg_conn):
+    mock_file = MagicMock()
+
+    hook = ExtendedPostgresHook(copy_chunk_bytes=65536)
+    hook.write_to_db(mock_file, 'id', 'test_table')
+
+    pg_conn.cursor().copy_expert.assert_called_once_with(ANY, mock_file, size=65536)
+    pg_conn.commit.assert_called_once()
+
+
+def test_copy_from_iter(pg_conn):
+    copied = []
+    pg_conn.cursor().copy_expert.side_effect = lambda sql, file, size: copied.append((sql, file.read()))
+
+    hook = ExtendedPostgresHook()
+    wrote_rows = hook.copy_from_iter(iter([[(1, 'a|b')], [], [(2, None)]]), '"id", "name"', 'test_table')
+
+    assert wrote_rows
+    assert copied == [(
+        'copy "test_table" ("id", "name") from stdin with csv delimiter \'|\' quote \'"\' null as \'\'',
+        b'1|"a|b"\r\n2|\r\n',
+    )]
+    pg_conn.commit.assert_called_once()
+
+
+def test_copy_from_iter_no_rows(pg_conn):
+    pg_conn.cursor().copy_expert.side_effect = lambda sql, file, size: file.read()
+
+    assert not ExtendedPostgresHook().copy_from_iter(iter([]), '"id"', 'test_table')
+
+
+def test_copy_rows_direct(pg_conn):
+    copied = []
+    pg_conn.cursor().copy_expert.side_effect = lambda sql, file, size: copied.append(file.read())
+
+    hook = ExtendedPostgresHook()
+    hook.copy_rows_direct([(1, 'a|b'), (2, None)], '"id", "name"', 'test_table')
+
+    assert copied == [b'1|"a|b"\r\n2|\r\n']
+    pg_conn.commit.assert_called_once()
+
+
+@patch.object(ExtendedPostgresHook, '_run_psql_commands_in_transaction')
+def test_swap_db_tables(mock_run_psql_commands_in_transaction):
+    hook = ExtendedPostgresHook()
+    hook.tmp_table = 'Tmptest_table'
+    hook.swap_table = 'Swaptest_table'
+    hook.drop_constraint_commands = []
+    hook.drop_index_commands = []
+    hook.sequences = []
+    hook.constraints = [{'name': 'test_constraint', 'definition': 'test_def', 'type': 'f'}]
+    hook.indexes = [{'name': 'test_index', 'definition': 'create index test_index on test_table (id)'}]
+
+    hook.swap_db_tables('test_table')
+
+    mock_run_psql_commands_in_transaction.assert_called_once_with([
+        'alter table if exists "test_table" rename to "Swaptest_table";',
+        'alter table if exists "Tmptest_table" rename to "test_table";',
+        'drop table if exists "Swaptest_table" cascade;',
+        'alter table if exists "test_table" add constraint "test_constraint" test_def;',
+        'create index test_index on test_table (id);',
+    ])
+
+
+@pytest.mark.parametrize('method_name, args, side_effect_target', [
+    ('_run_psql_commands_in_transaction', (['SELECT 1'],), 'execute'),
+    ('get_table_metadata', ('test_table', 'public', False), 'execute'),
+    ('write_to_db', (MagicMock(), 'id', 'test_table'), 'copy_expert'),
+])
+def test_error_path(pg_conn, method_name, args, side_effect_target):
+    getattr(pg_conn.cursor(), side_effect_target).side_effect = Exception('Test exception')
+
+    hook = ExtendedPostgresHook()
+
+    with pytest.raises(Exception, match='Test exception'):
+        getattr(hook, method_name)(*args)
+
+
+def test_run_psql_commands_in_transaction_rolls_back(pg_conn):
+    pg_conn.cursor().execute.side_effect = Exception('Test exception')
+
+    with pytest.raises(Exception, match='Test exception'):
+        ExtendedPostgresHook()._run_psql_commands_in_transaction(['SELECT 1'])
+
+    pg_conn.rollback.assert_called()
+
+
+def test_run_psql_commands_in_transaction_logs_failing_command(pg_conn):
+    commands = ['delete from a', 'insert into b select * from c;', 'drop table c']
+    error = Exception('Test exception')
+    # Postgres points at the insert in the joined batch
+    error.diag = MagicMock(statement_position=str(len('delete from a;\n') + 1))
+    pg_conn.cursor().execute.side_effect = error
+
+    hook = ExtendedPostgresHook()
+    with patch.object(hook.log, 'error') as mock_error:
+        with pytest.raises(Exception, match='Test exception'):
+            hook._run_psql_commands_in_transaction(commands)
+
+    # the batch isn't run again to find it
+    pg_conn.cursor().execute.assert_called_once()
+    mock_error.assert_called_with('[_run_psql_commands_in_transaction] failed command: %s', 'insert into b select * from c;')
+
+
+def test_run_psql_commands_in_transaction_rollback_fails(pg_conn):
+    pg_conn.cursor().execute.side_effect = Exception('Test exception')
+    pg_conn.rollback.side_effect = Exception('connection lost')
+
+    # the error from the batch is raised, not the one from the rollback
+    with pytest.raises(Exception, match='Test exception'):
+        ExtendedPostgresHook()._run_psql_commands_in_transaction(['SELECT 1'])
+
+
+def test_encode_numeric():
+    assert _encode_numeric('123.45') == struct.pack('>hhHHHH', 2, 0, 0, 2, 123, 4500)
+    assert _encode_numeric('-0.001') == struct.pack('>hhHHH', 1, -1, 0x4000, 3, 10)
+    assert _encode_numeric('0') == struct.pack('>hhHH', 0, 0, 0, 0)
+
+
+def test_encode_numeric_float():
+    # floats keep their shortest decimal form, not their binary expansion
+    assert _encode_numeric(0.1) == struct.pack('>hhHHH', 1, -1, 0, 1, 1000)
+    assert _encode_numeric(1.1) == struct.pack('>hhHHHH', 2, 0, 0, 1, 1, 1000)
+
+
+def test_write_to_db_binary_unsupported_type(pg_conn):
+    pg_conn.cursor().fetchall.return_value = [('id', 'integer', None), ('tags', 'ARRAY', None)]
+    arrow_table = MagicMock()
+    arrow_table.column_names = ['id', 'tags']
+
+    hook = ExtendedPostgresHook()
+
+    with pytest.raises(AirflowException):
+        hook.write_to_db_binary(arrow_table, 'test_table')
+
+    pg_conn.cursor().copy_expert.assert_not_called()
+
+
+def test_write_rows_to_db_binary(pg_conn):
+    pg_conn.cursor().fetchall.return_value = [('id', 'integer', None), ('name', 'text', None)]
+    copied = []
+    # read the way psycopg2 does, size bytes at a time
+    pg_conn.cursor().copy_expert.side_effect = lambda sql, file, size: copied.append((sql, b''.join(iter(lambda: file.read(size), b''))))
+
+    hook = ExtendedPostgresHook(copy_chunk_bytes=5)
+    wrote_rows = hook.write_rows_to_db_binary(iter([[(1, 'a')], [(2, None)]]), ['id', 'name'], 'test_table')
+
+    assert wrote_rows
+    sql, data = copied[0]
+    assert sql == 'copy "test_table" ("id", "name") from stdin with (format binary)'
+    assert data == (
+        PG_BINARY_COPY_HEADER
+        + struct.pack('>hii', 2, 4, 1) + struct.pack('>i', 1) + b'a'
+        + struct.pack('>hii', 2, 4, 2) + struct.pack('>i', -1)
+        + PG_BINARY_COPY_TRAILER
+    )
+    pg_conn.commit.assert_called_once()
@@ -1,49 +1,286 @@
-import unittest
-from unittest.mock import MagicMock, patch
-from tempfile import NamedTemporaryFile
+import csv
+import gzip
+import io
+import os
+from decimal import Decimal
+from unittest.mock import MagicMock, patch, ANY
 
+import pandas as pd
+import pytest
 from airflow.exceptions import AirflowException
-from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+from snowflake.connector.errors import NotSupportedError
+from snowflake.connector.result_batch import ArrowResultBatch
 
 from vivian_airflow_extensions.hooks.extended_snowflake_hook import ExtendedSnowflakeHook
 
-class TestExtendedSnowflakeHook(unittest.TestCase):
-    @patch.object(SnowflakeHook, 'get_conn')
-    def test_generate_rows_from_table(self, mock_get_conn):
-        mock_conn = MagicMock()
-        mock_get_conn.return_value = mock_conn
-        mock_cursor = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.description = [('column1',), ('column2',)]
-        mock_cursor.fetchmany.side_effect = [[('value1', 'value2')], []]
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
 
-        hook = ExtendedSnowflakeHook()
-        result = list(hook.generate_rows_from_table('SELECT * FROM table'))
+ARRAY_QUERY = 'select * replace (\'{\' || substr("column2"::varchar, 2, length("column2"::varchar) - 2) || \'}\' as "column2") from (SELECT * FROM table)'
 
-        self.assertEqual(result, [({'column1': 'value1', 'column2': 'value2'}, ['column1', 'column2'])])
 
-    def test_save_snowflake_results_to_tmp_file_invalid_destination_type(self):
-        hook = ExtendedSnowflakeHook()
+@pytest.fixture(autouse=True)
+def reset_hook_state():
+    yield
+    ExtendedSnowflakeHook.close_pools()
 
-        with self.assertRaises(AirflowException) as context:
-            hook.save_snowflake_results_to_tmp_file('SELECT * FROM table', [], None, 'invalid')
 
-        self.assertTrue('destination_type must be one of ["snowflake", "postgres"], not invalid' in str(context.exception))
+def test_generate_rows_from_table(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    result = list(hook.generate_rows_from_table('SELECT * FROM table'))
 
-    @patch.object(ExtendedSnowflakeHook, 'generate_rows_from_table')
-    def test_save_snowflake_results_to_tmp_file(self, mock_generate_rows_from_table):
-        mock_generate_rows_from_table.return_value = iter([({'column1': 'value1', 'column2': 'value2'}, ['column1', 'column2'])])
+    assert result == [({'column1': 'value1', 'column2': 'value2'}, ['column1', 'column2'])]
 
-        hook = ExtendedSnowflakeHook()
-        with NamedTemporaryFile(mode='w+', delete=True) as tmp:
-            result = hook.save_snowflake_results_to_tmp_file('SELECT * FROM table', [], tmp, 'snowflake')
 
-            self.assertTrue(result)
+def test_generate_dataframes_from_table(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    result = list(hook.generate_dataframes_from_table('SELECT * FROM table', 500))
 
-            tmp.seek(0)  # Go back to the start of the file to read it
-            lines = tmp.readlines()
+    assert len(result) == 1
+    assert result[0].to_dict(orient='records') == [{'column1': 'value1', 'column2': 'value2'}]
+    assert snowflake_cursor.arraysize == 500
+    snowflake_cursor.fetch_pandas_batches.assert_not_called()
 
-        self.assertEqual(lines, ['column1|column2\n', 'value1|value2\n'])
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+def test_generate_dataframes_from_table_null_int(snowflake_cursor):
+    snowflake_cursor.execute.side_effect = None
+    snowflake_cursor.fetchmany.side_effect = [[(2 ** 53 + 1, Decimal('1.10')), (None, None)], []]
+
+    hook = ExtendedSnowflakeHook()
+    df = next(hook.generate_dataframes_from_table('SELECT * FROM table'))
+
+    # the values the cursor returned, not floats
+    assert df['column1'].tolist() == [2 ** 53 + 1, None]
+    assert df['column2'].tolist() == [Decimal('1.10'), None]
+
+
+def test_generate_dataframes_from_table_arrow(snowflake_cursor):
+    batch = pd.DataFrame([('value1', 'value2')], columns=['column1', 'column2'])
+    snowflake_cursor.fetch_pandas_batches.return_value = iter([batch, batch.iloc[:0]])
+
+    hook = ExtendedSnowflakeHook()
+    result = list(hook.generate_dataframes_from_table('SELECT * FROM table', 500, use_arrow=True))
+
+    # empty batches are skipped
+    assert len(result) == 1
+    assert result[0] is batch
+    assert snowflake_cursor.arraysize == 500
+    snowflake_cursor.fetchmany.assert_not_called()
+
+
+@pytest.mark.skipif(pa is None, reason='pyarrow is not installed')
+def test_generate_dataframes_from_table_arrow_nullable_ints(snowflake_cursor):
+    snowflake_cursor.fetch_pandas_batches.side_effect = lambda types_mapper: iter([
+        pa.table({'column1': pa.array([2 ** 53 + 1, None], pa.int64())}).to_pandas(types_mapper=types_mapper)
+    ])
+
+    hook = ExtendedSnowflakeHook()
+    df = next(hook.generate_dataframes_from_table('SELECT * FROM table', use_arrow=True))
+
+    assert df['column1'].dtype == pd.Int64Dtype()
+    assert df['column1'][0] == 2 ** 53 + 1
+    assert df['column1'].isna().tolist() == [False, True]
+
+
+def test_generate_dataframes_from_table_arrow_fallback(snowflake_cursor):
+    snowflake_cursor.fetch_pandas_batches.side_effect = NotSupportedError('not arrow')
+
+    hook = ExtendedSnowflakeHook()
+    result = list(hook.generate_dataframes_from_table('SELECT * FROM table', use_arrow=True))
+
+    assert len(result) == 1
+    assert result[0].to_dict(orient='records') == [{'column1': 'value1', 'column2': 'value2'}]
+
+
+def test_iter_rows(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    result = list(hook.iter_rows('SELECT * FROM table', ['column2'], 'postgres'))
+
+    assert result == [[('value1', 'value2')]]
+    snowflake_cursor.execute.assert_called_with(ARRAY_QUERY)
+
+
+def test_arrow_batches(snowflake_cursor):
+    snowflake_cursor.get_result_batches.return_value = [
+        MagicMock(spec=ArrowResultBatch, **{'to_arrow.return_value': n}) for n in range(5)
+    ]
+
+    hook = ExtendedSnowflakeHook(fetch_parallelism=2)
+
+    # decoded in parallel, generated in order
+    assert list(hook.arrow_batches('SELECT * FROM table')) == [0, 1, 2, 3, 4]
+    snowflake_cursor.fetch_arrow_batches.assert_not_called()
+
+
+def test_arrow_batches_not_arrow(snowflake_cursor):
+    snowflake_cursor.get_result_batches.return_value = [MagicMock()]
+    snowflake_cursor.fetch_arrow_batches.return_value = iter(['batch'])
+
+    hook = ExtendedSnowflakeHook()
+
+    assert list(hook.arrow_batches('SELECT * FROM table')) == ['batch']
+
+
+def test_save_snowflake_results_to_tmp_file_invalid_destination_type():
+    hook = ExtendedSnowflakeHook()
+
+    with pytest.raises(AirflowException, match=r'destination_type must be one of \["snowflake", "postgres"\], not invalid'):
+        hook.save_snowflake_results_to_tmp_file('SELECT * FROM table', [], None, 'invalid')
+
+
+def test_save_rows_to_tmp_file(snowflake_cursor):
+    buffer = io.StringIO()
+
+    hook = ExtendedSnowflakeHook()
+
+    assert hook._save_rows_to_tmp_file('SELECT * FROM table', buffer)
+    assert buffer.getvalue().splitlines() == ['column1|column2', 'value1|value2']
+
+
+@patch.object(ExtendedSnowflakeHook, '_save_rows_to_tmp_file')
+def test_save_snowflake_results_to_tmp_file_array_fields(mock_save_rows_to_tmp_file, snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    with patch.dict('sys.modules', {'pyarrow.csv': None}):
+        hook.save_snowflake_results_to_tmp_file('SELECT * FROM table', ['column2'], MagicMock(), 'postgres')
+
+    # the arrays are reformatted by Snowflake, not in Python
+    mock_save_rows_to_tmp_file.assert_called_once_with(ARRAY_QUERY, ANY)
+
+
+@pytest.mark.skipif(pa is None, reason='pyarrow is not installed')
+@patch.object(ExtendedSnowflakeHook, 'arrow_batches')
+def test_save_snowflake_results_to_tmp_file(mock_arrow_batches):
+    mock_arrow_batches.return_value = iter([pa.table({'column1': ['value1'], 'column2': ['{1,2}']})])
+
+    buffer = io.StringIO()
+
+    hook = ExtendedSnowflakeHook()
+
+    assert hook.save_snowflake_results_to_tmp_file('SELECT * FROM table', [], buffer, 'postgres')
+    assert buffer.getvalue().splitlines() == ['"column1"|"column2"', '"value1"|"{1,2}"']
+
+
+def test_fetch_all_if_small(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+
+    assert hook.fetch_all_if_small('SELECT * FROM table', [], 10) == ([('value1', 'value2')], None)
+
+
+def test_fetch_all_if_small_large_result(snowflake_cursor):
+    snowflake_cursor.rowcount = 11
+
+    hook = ExtendedSnowflakeHook()
+    rows, row_chunks = hook.fetch_all_if_small('SELECT * FROM table', [], 10)
+
+    # the rest of the result comes from the cursor that already ran
+    assert rows is None
+    assert list(row_chunks) == [[('value1', 'value2')]]
+    snowflake_cursor.execute.assert_called_once_with('SELECT * FROM table')
+
+
+def test_array_fields_query(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+
+    assert hook._array_fields_query('SELECT * FROM table', []) == 'SELECT * FROM table'
+    assert hook._array_fields_query('SELECT * FROM table', ['column2']) == ARRAY_QUERY
+    snowflake_cursor.execute.assert_called_with('select * from (SELECT * FROM table) limit 0')
+
+
+def test_array_fields_query_reads_columns_once(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    hook.fetch_all_if_small('SELECT * FROM table', ['column2'], 10, 'postgres')
+    list(hook.iter_rows('SELECT * FROM table', ['column2'], 'postgres'))
+
+    assert [c[0][0] for c in snowflake_cursor.execute.call_args_list] == [
+        'select * from (SELECT * FROM table) limit 0',
+        ARRAY_QUERY,
+        ARRAY_QUERY,
+    ]
+
+
+def test_array_fields_query_missing_field(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+
+    # fields that aren't result columns are ignored, as they were when arrays were reformatted in Python
+    assert hook._array_fields_query('SELECT * FROM table', ['column2', 'missing']) == ARRAY_QUERY
+    assert hook._array_fields_query('SELECT * FROM table', ['missing']) == 'SELECT * FROM table'
+
+
+def test_array_fields_query_quotes_identifiers(snowflake_cursor):
+    snowflake_cursor.description = [('say "hi"',)]
+
+    hook = ExtendedSnowflakeHook()
+
+    assert hook._array_fields_query('SELECT * FROM table', ['say "hi"']) == (
+        'select * replace (\'{\' || substr("say ""hi"""::varchar, 2, length("say ""hi"""::varchar) - 2) || \'}\' as "say ""hi""") from (SELECT * FROM table)'
+    )
+
+
+def test_save_via_stage_no_rows(snowflake_cursor):
+    snowflake_cursor.fetchall.return_value = [(0, 0, 0)]
+
+    hook = ExtendedSnowflakeHook()
+    result = hook.save_via_stage('SELECT * FROM table', [], io.StringIO(), 'postgres')
+
+    assert not result
+    assert snowflake_cursor.execute.call_args_list[-1][0][0].startswith('remove @~/airflow_tmp/')
+    # the connection goes back to the pool instead of being closed
+    hook.get_conn.return_value.close.assert_not_called()
+
+
+def test_save_via_stage_round_trip(snowflake_cursor):
+    # what Snowflake unloads with the stage file format: no escaping outside quotes, and microseconds
+    unloaded = 'column1|column2\na\\b|2022-01-01 00:00:00.123456 +00:00\n'
+
+    def execute(sql, *args, **kwargs):
+        if sql.startswith('get '):
+            tmp_dir = sql.split("'file://")[1].rstrip("/'")
+            with gzip.open(os.path.join(tmp_dir, 'data_0_0_0.csv.gz'), 'wt') as part:
+                part.write(unloaded)
+
+    snowflake_cursor.execute.side_effect = execute
+    snowflake_cursor.fetchall.return_value = [(1, 100, 50)]
+    buffer = io.StringIO()
+
+    hook = ExtendedSnowflakeHook()
+
+    assert hook.save_via_stage('SELECT * FROM table', [], buffer, 'postgres')
+    copy_sql = snowflake_cursor.execute.call_args_list[0][0][0]
+    assert 'escape_unenclosed_field=none' in copy_sql
+    assert "timestamp_format='YYYY-MM-DD HH24:MI:SS.FF6 TZH:TZM'" in copy_sql
+    # COPY reads one backslash and every microsecond, as it does from the cursor path
+    assert list(csv.reader(io.StringIO(buffer.getvalue()), delimiter='|', quotechar='"')) == [
+        ['column1', 'column2'],
+        ['a\\b', '2022-01-01 00:00:00.123456 +00:00'],
+    ]
+
+
+def test_connection_reused(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    hook.fetch_all_if_small('SELECT * FROM table', [], 10)
+    ExtendedSnowflakeHook().fetch_all_if_small('SELECT * FROM table', [], 10)
+
+    hook.get_conn.assert_called_once()
+
+
+
+def test_connection_not_shared_across_session_settings(snowflake_cursor):
+    ExtendedSnowflakeHook().fetch_all_if_small('SELECT * FROM table', [], 10)
+    hook = ExtendedSnowflakeHook(warehouse='other_warehouse')
+    hook.fetch_all_if_small('SELECT * FROM table', [], 10)
+
+    assert hook.get_conn.call_count == 2
+
+
+def test_close_pool(snowflake_cursor):
+    hook = ExtendedSnowflakeHook()
+    hook.fetch_all_if_small('SELECT * FROM table', [], 10)
+    conn = hook.get_conn.return_value
+    conn.close.assert_not_called()
+
+    hook.close_pool()
+
+    conn.close.assert_called_once()
+    assert not ExtendedSnowflakeHook._pools
@@ -1,62 +1,100 @@
-import unittest
 from unittest.mock import patch, MagicMock
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 
+import pytest
 from airflow.exceptions import AirflowException
+from botocore.exceptions import ClientError
 
 from vivian_airflow_extensions.hooks.s3_bookmark_hook import S3BookmarkHook
 
-class TestS3BookmarkHook(unittest.TestCase):
-    def test_init(self):
-        with self.assertRaises(AirflowException):
-            S3BookmarkHook()
+BOOKMARK_S3_KEY = 's3://test-bucket/bookmarks/test_key.txt'
 
-        with self.assertRaises(AirflowException):
-            S3BookmarkHook(bookmark_s3_key='test_key')
 
-        hook = S3BookmarkHook(bookmark_s3_key='test_key', incremental_key_type='int')
-        self.assertEqual(hook.bookmark_s3_key, 'test_key')
-        self.assertEqual(hook.incremental_key_type, 'int')
+@pytest.fixture(scope='module')
+def mock_s3_client_factory():
+    # plain MagicMocks, not autospec: none of these tests assert on boto3's signatures
+    with patch('vivian_airflow_extensions.hooks.s3_bookmark_hook._s3_client') as m:
+        yield m
 
-    @patch('s3fs.S3FileSystem')
-    def test_get_latest_bookmark(self, mock_s3fs):
-        mock_file = MagicMock()
-        mock_file.read.return_value = '123\n'
-        mock_s3fs().open.return_value.__enter__.return_value = mock_file
 
-        hook = S3BookmarkHook(bookmark_s3_key='test_key', incremental_key_type='int')
-        bookmark = hook.get_latest_bookmark()
+@pytest.fixture
+def s3_client(mock_s3_client_factory):
+    """
+    The client returned by _s3_client, fresh for each test so calls don't leak
+    between them.
+    """
+    mock_s3_client_factory.return_value = MagicMock()
+    return mock_s3_client_factory.return_value
 
-        self.assertEqual(bookmark, '123')
 
-    @patch('s3fs.S3FileSystem')
-    def test_get_latest_bookmark_file_not_found(self, mock_s3fs):
-        mock_s3fs().open.side_effect = FileNotFoundError
+def test_init():
+    with pytest.raises(AirflowException):
+        S3BookmarkHook()
 
-        hook = S3BookmarkHook(bookmark_s3_key='test_key', incremental_key_type='int')
-        bookmark = hook.get_latest_bookmark()
+    with pytest.raises(AirflowException):
+        S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY)
 
-        self.assertEqual(bookmark, 0)
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+    assert hook.bookmark_s3_key == BOOKMARK_S3_KEY
+    assert hook.incremental_key_type == 'int'
+    assert hook.bucket == 'test-bucket'
+    assert hook.key == 'bookmarks/test_key.txt'
 
-    @patch('s3fs.S3FileSystem')
-    def test_save_next_bookmark(self, mock_s3fs):
-        mock_file = MagicMock()
-        mock_s3fs().open.return_value.__enter__.return_value = mock_file
 
-        hook = S3BookmarkHook(bookmark_s3_key='test_key', incremental_key_type='int')
-        hook.save_next_bookmark(datetime(2022, 1, 1))
+def test_get_latest_bookmark(s3_client):
+    s3_client.get_object.return_value = {'Body': MagicMock(read=MagicMock(return_value=b'123\n'))}
 
-        mock_file.write.assert_called_once_with('2022-01-01 00:00:00')
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
 
-    @patch('s3fs.S3FileSystem')
-    def test_save_next_bookmark_none(self, mock_s3fs):
-        mock_file = MagicMock()
-        mock_s3fs().open.return_value.__enter__.return_value = mock_file
+    assert hook.get_latest_bookmark() == '123'
+    s3_client.get_object.assert_called_once_with(Bucket='test-bucket', Key='bookmarks/test_key.txt')
 
-        hook = S3BookmarkHook(bookmark_s3_key='test_key', incremental_key_type='int')
-        hook.save_next_bookmark(None)
 
-        mock_file.write.assert_not_called()
+def test_get_latest_bookmark_file_not_found(s3_client):
+    s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+
+    assert hook.get_latest_bookmark() == 0
+
+
+def test_get_latest_bookmark_access_denied(s3_client):
+    s3_client.get_object.side_effect = ClientError({'Error': {'Code': 'AccessDenied'}}, 'GetObject')
+
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+
+    with pytest.raises(ClientError):
+        hook.get_latest_bookmark()
+
+
+def test_save_next_bookmark(s3_client):
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+    hook.save_next_bookmark(datetime(2022, 1, 1))
+
+    s3_client.put_object.assert_called_once_with(Bucket='test-bucket', Key='bookmarks/test_key.txt', Body=b'2022-01-01 00:00:00')
+
+
+def test_save_next_bookmark_aware(s3_client):
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='timestamp')
+    hook.save_next_bookmark(datetime(2022, 1, 1, 2, 30, 15, 999, tzinfo=timezone(timedelta(hours=2))))
+
+    # the wall-clock time is kept, not converted to UTC
+    s3_client.put_object.assert_called_once_with(Bucket='test-bucket', Key='bookmarks/test_key.txt', Body=b'2022-01-01 02:30:15')
+
+
+@pytest.mark.parametrize('bookmark, saved', [
+    (date(2022, 1, 1), b'2022-01-01 00:00:00'),
+    (123, b'123'),
+], ids=['date', 'int'])
+def test_save_next_bookmark_other_types(s3_client, bookmark, saved):
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+    hook.save_next_bookmark(bookmark)
+
+    s3_client.put_object.assert_called_once_with(Bucket='test-bucket', Key='bookmarks/test_key.txt', Body=saved)
+
+
+def test_save_next_bookmark_none(s3_client):
+    hook = S3BookmarkHook(bookmark_s3_key=BOOKMARK_S3_KEY, incremental_key_type='int')
+    hook.save_next_bookmark(None)
+
+    s3_client.put_object.assert_not_called()
@@ -1,129 +1,132 @@
-import unittest
 from unittest.mock import patch, MagicMock
 from datetime import datetime
+
+import pytest
 from airflow.exceptions import AirflowException
+from freezegun import freeze_time
 
 from vivian_airflow_extensions.hooks.stitch_hook import StitchHook
 
-class TestStitchHook(unittest.TestCase):
-    @patch.object(StitchHook, 'get_connection')
-    def test_get_credentials(self, mock_get_connection):
-        conn = MagicMock()
-        conn.host = 'test_host'
-        conn.extra_dejson = {'extra': 'data'}
-        mock_get_connection.return_value = conn
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
+@patch.object(StitchHook, 'get_connection')
+def test_get_credentials(mock_get_connection):
+    conn = MagicMock()
+    conn.host = 'test_host'
+    conn.extra_dejson = {'extra': 'data'}
+    mock_get_connection.return_value = conn
+
+    stitch_hook = StitchHook(conn_id='test_conn_id')
+    stitch_hook.get_credentials()
+
+    assert stitch_hook.host == 'test_host'
+    assert stitch_hook.headers == {'extra': 'data'}
+
+
+@patch.object(StitchHook, 'get_connection')
+def test_get_credentials_cached(mock_get_connection):
+    stitch_hook = StitchHook(conn_id='test_conn_id', credentials_ttl=60)
+
+    with freeze_time('2022-01-01 00:00:00') as frozen:
+        stitch_hook.get_credentials()
         stitch_hook.get_credentials()
+        assert mock_get_connection.call_count == 1
 
-        self.assertEqual(stitch_hook.host, 'test_host')
-        self.assertEqual(stitch_hook.headers, {'extra': 'data'})
+        frozen.tick(60)
+        stitch_hook.get_credentials()
+        assert mock_get_connection.call_count == 2
 
-    @patch('requests.request')
-    def test_get_response(self, mock_request):
-        mock_response = MagicMock()
-        mock_response.text = '{"key": "value"}'
-        mock_request.return_value = mock_response
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
-        stitch_hook.headers = {'extra': 'data'}
+@patch('requests.request')
+def test_get_response(mock_request):
+    mock_request.return_value.text = '{"key": "value"}'
 
-        response = stitch_hook._get_response('test_url', 'GET')
+    stitch_hook = StitchHook(conn_id='test_conn_id')
+    stitch_hook.host = 'test_host'
+    stitch_hook.headers = {'extra': 'data'}
 
-        self.assertEqual(response, {'key': 'value'})
+    assert stitch_hook._get_response('test_url', 'GET') == {'key': 'value'}
 
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_trigger_extraction(self, mock_get_response, mock_get_credentials):
-        mock_get_response.return_value = {'job_name': 'test_job_name'}
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
+def test_trigger_extraction(stitch_hook):
+    stitch_hook._get_response.return_value = {'job_name': 'test_job_name'}
 
-        stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
+    stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
 
-        mock_get_response.assert_called_once_with(f'{stitch_hook.host}/sources/test_source_id/sync', 'POST')
+    stitch_hook._get_response.assert_called_once_with(f'{stitch_hook.host}/sources/test_source_id/sync', 'POST')
 
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_trigger_extraction_error(self, mock_get_response, mock_get_credentials):
-        mock_get_response.return_value = {'error': {'type': 'test_type', 'message': 'test_message'}}
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
+def test_trigger_extraction_error(stitch_hook):
+    stitch_hook._get_response.return_value = {'error': {'type': 'test_type', 'message': 'test_message'}}
+
+    with pytest.raises(AirflowException):
+        stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
 
-        with self.assertRaises(AirflowException):
-            stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
 
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_trigger_extraction_no_job_name(self, mock_get_response, mock_get_credentials):
-        mock_get_response.return_value = {}
+def test_trigger_extraction_no_job_name(stitch_hook):
+    stitch_hook._get_response.return_value = {}
+
+    with pytest.raises(AirflowException):
+        stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
 
-        with self.assertRaises(AirflowException):
-            stitch_hook.trigger_extraction('test_source_id', 'test_client_id')
+def _extraction(completion_time, tap_exit_status):
+    return {
+        'data': [{'source_id': 'test_source_id', 'completion_time': completion_time, 'tap_exit_status': tap_exit_status}],
+        'links': {}
+    }
 
-    @patch('time.sleep', return_value=None)
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_monitor_extraction(self, mock_get_response, mock_get_credentials, mock_sleep):
-        mock_get_response.return_value = {
-            'data': [{'source_id': 'test_source_id', 'completion_time': '2022-01-01T00:00:00Z', 'tap_exit_status': 0}],
-            'links': {}
-        }
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
+@pytest.mark.parametrize('response, raises', [
+    (_extraction('2022-01-01T00:00:00Z', 0), False),
+    ({'data': [], 'links': {}}, True),  # source_id not found
+    (_extraction('2022-01-01T00:00:00Z', 1), True),  # extraction failed
+], ids=['succeeded', 'source_id_not_found', 'extraction_failed'])
+def test_monitor_extraction(stitch_hook, response, raises):
+    stitch_hook._get_response.return_value = response
 
+    if raises:
+        with pytest.raises(AirflowException):
+            stitch_hook.monitor_extraction('test_source_id', 'test_client_id', start_time=datetime(2022, 1, 1))
+    else:
         stitch_hook.monitor_extraction('test_source_id', 'test_client_id', start_time=datetime(2022, 1, 1))
+        stitch_hook._get_response.assert_called()
 
-        mock_get_response.assert_called()
 
-    @patch('time.sleep', return_value=None)
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_monitor_extraction_source_id_not_found(self, mock_get_response, mock_get_credentials, mock_sleep):
-        mock_get_response.return_value = {'data': [], 'links': {}}
+def test_monitor_extraction_timeout(stitch_hook, no_sleep):
+    stitch_hook.poll_interval = 10
+    stitch_hook._get_response.return_value = _extraction('2021-12-31T23:59:59Z', 0)
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
+    with freeze_time('2022-01-01 00:00:00') as frozen:
+        no_sleep.side_effect = frozen.tick
 
-        with self.assertRaises(AirflowException):
-            stitch_hook.monitor_extraction('test_source_id', 'test_client_id', start_time=datetime(2022, 1, 1))
+        with pytest.raises(AirflowException, match='timed out'):
+            stitch_hook.monitor_extraction('test_source_id', 'test_client_id', timeout=60, start_time=datetime(2022, 1, 1))
 
-    @patch('time.sleep', return_value=None)
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_monitor_extraction_extraction_failed(self, mock_get_response, mock_get_credentials, mock_sleep):
-        mock_get_response.return_value = {
-            'data': [{'source_id': 'test_source_id', 'completion_time': '2022-01-01T00:00:00Z', 'tap_exit_status': 1}],
-            'links': {}
-        }
+    # waited 10s, then polled at 10s, 20s and 40s before passing the timeout at 80s
+    assert stitch_hook._get_response.call_count == 3
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
 
-        with self.assertRaises(AirflowException):
-            stitch_hook.monitor_extraction('test_source_id', 'test_client_id', start_time=datetime(2022, 1, 1))
+def test_monitor_extraction_backoff(stitch_hook, no_sleep):
+    stitch_hook.poll_interval = 10
+    stitch_hook._get_response.side_effect = [
+        _extraction('2021-12-31T23:00:00Z', 0),
+        _extraction('2021-12-31T23:00:00Z', 0),
+        _extraction('2021-12-31T23:00:00Z', 0),
+        _extraction('2021-12-31T23:30:00Z', 0),
+        _extraction('2022-01-01T00:00:00Z', 0),
+    ]
+
+    stitch_hook.monitor_extraction('test_source_id', 'test_client_id', sleep_time=30, start_time=datetime(2022, 1, 1))
 
-    @patch('time.sleep', return_value=None)
-    @patch.object(StitchHook, 'get_credentials')
-    @patch.object(StitchHook, '_get_response')
-    def test_monitor_extraction_timeout(self, mock_get_response, mock_get_credentials, mock_sleep):
-        mock_get_response.return_value = {
-            'data': [{'source_id': 'test_source_id', 'completion_time': '2021-12-31T23:59:59Z', 'tap_exit_status': 0}],
-            'links': {}
-        }
+    # doubles up to sleep_time, and starts over when the completion time moves
+    assert [c[0][0] for c in no_sleep.call_args_list] == [10, 10, 20, 30, 10]
 
-        stitch_hook = StitchHook(conn_id='test_conn_id')
-        stitch_hook.host = 'test_host'
 
-        with self.assertRaises(AirflowException):
-            stitch_hook.monitor_extraction('test_source_id', 'test_client_id', start_time=datetime(2022, 1, 1), timeout=1)
+def test_extraction_succeeded(stitch_hook):
+    stitch_hook._get_response.side_effect = [
+        {'data': [], 'links': {'next': '/v4/test_client_id/extractions?page=2'}},
+        _extraction('2021-12-31T23:59:59Z', 0),
+    ]
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    assert not stitch_hook.extraction_succeeded('test_source_id', 'test_client_id', datetime(2022, 1, 1))
+    stitch_hook._get_response.assert_called_with('https://api.stitchdata.com/v4/test_client_id/extractions?page=2', 'GET')
@@ -1,19 +1,49 @@
-import json
-import time
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 from typing import Callable, Union, List
 from decimal import Decimal
 
 import pandas as pd
-import numpy as np
 from airflow.models.baseoperator import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 from pynamodb.models import Model
+from tenacity import retry, stop_after_attempt, wait_exponential
 
 from ..hooks.extended_snowflake_hook import ExtendedSnowflakeHook
 from ..hooks.s3_bookmark_hook import S3BookmarkHook
 
+try:
+    # several times faster than the standard library on typical payloads
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+NON_ALPHANUMERIC = re.compile(r'[\W_]+')
+BOOKMARK_COLUMN = '_airflow_bookmark'
+
+
+def _log_retry(retry_state):
+    operator, *_, row_dict = retry_state.args
+    operator.log.info(f'An error occurred while writing the following entry. Error: {retry_state.outcome.exception()} from item {row_dict}. Retrying...')
+
+
+def _log_failure(retry_state):
+    operator, *_, row_dict = retry_state.args
+    operator.log.error(row_dict)
+    raise retry_state.outcome.exception()
+
+
+# retries a write of one row, backing off from half a second up to 10 seconds between tries
+retry_row_write = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, max=10),
+    before_sleep=_log_retry,
+    retry_error_callback=_log_failure,
+)
+
 
 class SnowflakeToDynamoOperator(BaseOperator):
     ui_color = '#cde4ec'
@@ -22,7 +52,9 @@ class SnowflakeToDynamoOperator(BaseOperator):
     @apply_defaults
     def __init__(self, dynamo_model: Model=None, snowflake_query: str=None, cleaning_function: Union[Callable, None]=None, chunksize: int=10000,
                  column_format: Union[str, None]='camel', add_updated_at: bool=True, snowflake_conn_id:str ='snowflake_default', 
-                 ttl_timestamp: str=None, update_existing: bool=False, json_fields: List[str]=[], *args, **kwargs) -> None:
+                 ttl_timestamp: str=None, update_existing: bool=False, json_fields: List[str]=[],
+                 update_parallelism: int=16, batch_cleaning_function: Union[Callable, None]=None, use_arrow_batches: bool=False,
+                 *args, **kwargs) -> None:
         """
         Runs a SQL query on Snowflake to pull data and loads the result to
         a DynamoDB table. Includes an option for specifying a
@@ -35,6 +67,12 @@ class SnowflakeToDynamoOperator(BaseOperator):
             must take 2 args: the row in dict format and the list of column
             names defined in the dynamo_model, and it must return 1 dict
             with the final data, formatted for the DynamoDB load. Optional.
+        :param batch_cleaning_function: Like cleaning_function, but applied to a
+            whole chunk of rows at once, so conversions can be done a column at a
+            time with pandas instead of row by row. It must take 1 arg, the
+            chunk as a DataFrame (with the columns renamed and Decimal columns
+            cast to floats), and return the cleaned DataFrame. Runs before
+            cleaning_function if both are set. Optional.
         :param chunksize: The number of rows to pull from Snowflake at a time.
             More rows means slightly faster performance but more memory usage.
             Defaults to 10,000.
@@ -54,12 +92,20 @@ class SnowflakeToDynamoOperator(BaseOperator):
             for records that already exist, fields that are not in the query will not
             be changed. For new records, there's no change; they will get inserted
             normally. WARNING: this is much slower than simple inserts/overwrites
-            because the updates are not batched. Defaults to False.
+            because the updates are not batched; they are sent update_parallelism
+            at a time instead. Defaults to False.
         :param json_fields: A list of field names which contain JSON. These will be
             parsed and converted to JSON format before loading into DynamoDB. If you
             load a JSON field without including it in this list, it will be loaded as a
             string. These field names will be called *after* applying the column
             formatting (camel or lower).
+        :param update_parallelism: The number of updates sent to DynamoDB at the
+            same time when update_existing is True. Defaults to 16.
+        :param use_arrow_batches: If True, build the chunks from Snowflake's Arrow
+            result batches, which is faster for large results. The values the
+            cleaning functions get change: integer columns have the nullable Int64
+            dtype, and dates and timestamps are pandas types. Otherwise every value
+            is the one the Snowflake cursor returned. Defaults to False.
         """
         super().__init__(*args, **kwargs)
 
@@ -75,6 +121,7 @@ class SnowflakeToDynamoOperator(BaseOperator):
         self.dynamo_model = dynamo_model
         self.snowflake_query = snowflake_query
         self.cleaning_function = cleaning_function
+        self.batch_cleaning_function = batch_cleaning_function
         self.snowflake_conn_id = snowflake_conn_id
         self.chunksize = chunksize
         self.column_format = column_format
@@ -82,12 +129,24 @@ class SnowflakeToDynamoOperator(BaseOperator):
         self.ttl_timestamp = ttl_timestamp
         self.update_existing = update_existing
         self.json_fields = json_fields
+        self.update_parallelism = update_parallelism
+        self.use_arrow_batches = use_arrow_batches
         self.snowflake_hook = ExtendedSnowflakeHook(snowflake_conn_id=snowflake_conn_id)
         if self.column_format == 'camel':
             self.json_fields = [self._camel_case(field) for field in self.json_fields]
         else:
             self.json_fields = [field.lower() for field in self.json_fields]
-        
+        self._column_map = None
+        self._decimal_columns = None
+        self._unchecked_columns = []
+        self._updated_at_key = 'updatedAt' if self.column_format == 'camel' else 'updated_at'
+        self._ttl_value = None
+
+        # the model's attributes don't change, so they're looked up once here instead of on every load
+        self._model_columns = tuple(dynamo_model._attributes.keys())
+        self._model_keys = (dynamo_model._hash_keyname,) + ((dynamo_model._range_keyname,) if dynamo_model._range_keyname else ())
+        self._non_key_attrs = tuple(key for key in self._model_columns if key not in self._model_keys)
+
     def _convert_nan(self, item):
         """
         Convert NaN values to None for dynamo compatibility.
@@ -95,142 +154,204 @@ class SnowflakeToDynamoOperator(BaseOperator):
         :param item: The item to check for NaN values.
         :return: The item with NaN values converted.
         """
-        if isinstance(item, (list, tuple, np.ndarray, pd.Series, pd.DataFrame)):
-            return item
-        elif pd.isna(item):
+        # NaN is the only value that isn't equal to itself
+        if isinstance(item, float) and item != item:
             return None
-        else:
-            return item
+        return item
+
+    def _clean_row(self, row_dict):
+        """
+        Run the user-supplied cleaning_function on a formatted row and convert any
+        NaN it leaves to None. _format_chunk already replaced the missing values,
+        so without a cleaning_function the row is returned as it is.
+
+        :param row_dict: The formatted row.
+        :return: The cleaned row.
+        """
+        if self.cleaning_function is None:
+            return row_dict
 
-    def _camel_case(self, string):
+        row_dict = self.cleaning_function(row_dict, self._model_columns)
+        return {key: self._convert_nan(value) for key, value in row_dict.items()}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _camel_case(string):
         """
-        Convert a string to camel case.
+        Convert a string to camel case. Results are cached, since the same column
+        names are converted for every chunk.
 
         :param string: The string to convert.
         :return: The string in camel case.
         """
-        output = ''.join(x for x in string.title() if x.isalnum())
-        return output[0].lower() + output[1:]
+        output = NON_ALPHANUMERIC.sub('', string.title())
+        return output[:1].lower() + output[1:]
     
-    def _format_for_dynamo(self, row_dict, updated_at):
-        if self.column_format == 'camel':
-            row_dict = {self._camel_case(key): value for key, value in row_dict.items()}
-        elif self.column_format == 'lower':
-            row_dict = {key.lower(): value for key, value in row_dict.items()}
-
-        row_dict = {key: float(value) if isinstance(value, Decimal) else value for key, value in row_dict.items()}
+    def _generate_chunks(self):
+        """
+        Run the Snowflake query and generate its results as DataFrames, straight
+        from Snowflake's Arrow result batches if use_arrow_batches is set.
+        """
+        yield from self.snowflake_hook.generate_dataframes_from_table(self.snowflake_query, self.chunksize, use_arrow=self.use_arrow_batches)
 
-        if self.add_updated_at:
+    def _format_chunk(self, df, updated_at):
+        """
+        Apply the default reformatting for dynamo uploads to a chunk of rows at
+        once: rename the columns, cast Decimal columns to floats, run the
+        batch_cleaning_function, convert missing values to None, parse the JSON
+        fields and add the constant fields.
+
+        :param df: The chunk of rows, as a DataFrame.
+        :param updated_at: The value of the updated_at field.
+        :return: The formatted rows, as a list of dicts.
+        """
+        if self._column_map is None:
+            # every chunk has the same columns, so the new names are only worked out once
             if self.column_format == 'camel':
-                row_dict['updatedAt'] = updated_at
+                self._column_map = {column: self._camel_case(column) for column in df.columns}
+            elif self.column_format == 'lower':
+                self._column_map = {column: column.lower() for column in df.columns}
             else:
-                row_dict['updated_at'] = updated_at
-
-        if self.ttl_timestamp is not None:
-            row_dict['_airflow_ttl'] = float(self.ttl_timestamp)
+                self._column_map = {}
+        if self._column_map:
+            df = df.rename(columns=self._column_map)
+
+        if self._decimal_columns is None:
+            self._decimal_columns = []
+            self._unchecked_columns = [column for column in df.columns if df[column].dtype == object]
+        if self._unchecked_columns:
+            # a column's type is the same in every chunk, so each one is only checked until it has a value
+            unchecked_columns = []
+            for column in self._unchecked_columns:
+                first_valid = df[column].first_valid_index()
+                if first_valid is None:
+                    unchecked_columns.append(column)
+                elif isinstance(df[column][first_valid], Decimal):
+                    self._decimal_columns.append(column)
+            self._unchecked_columns = unchecked_columns
+        if self._decimal_columns:
+            df[self._decimal_columns] = df[self._decimal_columns].astype('float64')
+
+        if self.batch_cleaning_function is not None:
+            df = self.batch_cleaning_function(df)
+
+        # object dtype so that missing values become None instead of NaN
+        df = df.astype(object).where(pd.notna(df), None)
 
         for field in self.json_fields:
-            if pd.isna(row_dict[field]):
-                row_dict[field] = None
-            else:
-                row_dict[field] = json.loads(row_dict[field])
+            df[field] = df[field].map(lambda value: json_loads(value) if value is not None else None)
+
+        constant_fields = {}
+        if self.add_updated_at:
+            constant_fields[self._updated_at_key] = updated_at
 
-        return row_dict
+        if self._ttl_value is not None:
+            constant_fields['_airflow_ttl'] = self._ttl_value
 
-    def _update(self, rows_generator):
+        records = df.to_dict(orient='records')
+        if constant_fields:
+            for record in records:
+                record.update(constant_fields)
+
+        return records
+
+    def _update(self, chunks):
         """
         Update the DynamoDB table with the given rows.
 
-        :param rows_generator: An generator that yields the rows to update.
+        :param chunks: A generator that yields the rows to update, as DataFrames.
         """
-        model_columns = self.dynamo_model._attributes.keys()
-        model_keys = [self.dynamo_model._hash_keyname]
-        if self.dynamo_model._range_keyname is not None:
-            model_keys.append(self.dynamo_model._range_keyname)
-        key_schema = lambda x: [x.get(key) for key in model_keys]
+        model_keys = self._model_keys
+
+        # resolve the attribute action builders once instead of for every value of every row
+        attributes = self.dynamo_model._attributes
+        attribute_setters = {key: attributes[key].set for key in self._non_key_attrs}
+        attribute_removers = {key: attributes[key].remove for key in self._non_key_attrs}
 
         n = 0
         self.log.info(f'Starting UPDATE load to {self.dynamo_model}')
         updated_at = datetime.now()
-        for row_dict, _ in rows_generator:
-            # run the default reformatting for dynamo uploads
-            row_dict = self._format_for_dynamo(row_dict, updated_at)
-
-            # run the user-supplied cleaning function
-            if self.cleaning_function is not None:
-                row_dict = self.cleaning_function(row_dict, model_columns)
-
-            # convert NaN to None
-            row_dict = {key: self._convert_nan(value) for key, value in row_dict.items()}
-
-            record = self.dynamo_model(*key_schema(row_dict))
-            update_actions = [self.dynamo_model._attributes.get(key).set(value) for key, value in row_dict.items() if key not in model_keys and value is not None]
-            # null attributes will be removed if set
-            remove_actions = [self.dynamo_model._attributes.get(key).remove() for key, value in row_dict.items() if key not in model_keys and value is None]
-            actions = update_actions + remove_actions
-
-            tries = 3
-            for attempt in range(tries):
-                try:
-                    record.update(actions=actions)
-                except Exception as e:
-                    if attempt < tries - 1:
-                        self.log.info(f'An error occurred while updating the following entry. Retrying... {row_dict}')
-                        time.sleep(10)
-                        continue
-                    else:
-                        self.log.error(row_dict)
-                        raise e
-                break
-            n += 1
+        rows = (row_dict for chunk in chunks for row_dict in self._format_chunk(chunk, updated_at))
+        with ThreadPoolExecutor(max_workers=self.update_parallelism) as executor:
+            pending = set()
+            for row_dict in rows:
+                row_dict = self._clean_row(row_dict)
+
+                record = self.dynamo_model(*[row_dict.get(key) for key in model_keys])
+                update_actions = [attribute_setters[key](value) for key, value in row_dict.items() if value is not None and key not in model_keys]
+                # null attributes will be removed if set
+                remove_actions = [attribute_removers[key]() for key, value in row_dict.items() if value is None and key not in model_keys]
+                actions = update_actions + remove_actions
+
+                pending.add(executor.submit(self._update_record, record, actions, row_dict))
+                # keep a bounded number of updates in flight
+                if len(pending) >= 2 * self.update_parallelism:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        n += 1
+
+            for future in pending:
+                future.result()
+                n += 1
 
         self.log.info(f'Loaded {n} rows total')
 
-    def _insert(self, rows_generator):
+    @retry_row_write
+    def _update_record(self, record, actions, row_dict):
+        """
+        Apply the update actions to a single DynamoDB record, retrying on errors.
+
+        :param record: The record to update.
+        :param actions: The update actions to apply.
+        :param row_dict: The row the actions were built from, for logging.
+        """
+        record.update(actions=actions)
+
+    @retry_row_write
+    def _save_record(self, batch_writer, row_dict):
+        """
+        Add a single row to the batch write, retrying on errors.
+
+        :param batch_writer: The model's batch writer.
+        :param row_dict: The row to save.
+        """
+        batch_writer.save(self.dynamo_model(**row_dict))
+
+    def _insert(self, chunks):
         """
         Insert the given rows into the DynamoDB table.
 
-        :param rows_generator: An generator that yields the rows to insert.
+        :param chunks: A generator that yields the rows to insert, as DataFrames.
         """
-        model_columns = self.dynamo_model._attributes.keys()
         n = 0
         with self.dynamo_model.batch_write() as batch_writer:
             updated_at = datetime.now()
-            for row_dict, _ in rows_generator:
-                # run the default reformatting for dynamo uploads
-                row_dict = self._format_for_dynamo(row_dict, updated_at)
-
-                # run the user-supplied cleaning function
-                if self.cleaning_function is not None:
-                    row_dict = self.cleaning_function(row_dict, model_columns)
-
-                # convert NaN to None
-                row_dict = {key: self._convert_nan(value) for key, value in row_dict.items()}
+            rows = (row_dict for chunk in chunks for row_dict in self._format_chunk(chunk, updated_at))
+            for row_dict in rows:
+                row_dict = self._clean_row(row_dict)
 
                 # save results
-                tries = 3
-                for attempt in range(tries):
-                    try:
-                        batch_writer.save(self.dynamo_model(**row_dict))
-                        break
-                    except Exception as e:
-                        if attempt < tries - 1:
-                            self.log.info(f'An error occurred while inserting the following entry. Error: {e} from item {row_dict}. Retrying...')
-                            time.sleep(1)
-                        else:
-                            self.log.error(row_dict)
-                            raise e
+                self._save_record(batch_writer, row_dict)
                 n += 1
 
         self.log.info(f'Loaded {n} rows')
 
     def execute(self, context):
-        rows_generator = self.snowflake_hook.generate_rows_from_table(self.snowflake_query)
-
-        if not self.update_existing:
-            self._insert(rows_generator)
-        else:
-            self._update(rows_generator)
+        self._column_map = None
+        self._decimal_columns = None
+        # ttl_timestamp is templated, so it can only be cast once it has been rendered
+        self._ttl_value = float(self.ttl_timestamp) if self.ttl_timestamp is not None else None
+        chunks = self._generate_chunks()
+
+        try:
+            if not self.update_existing:
+                self._insert(chunks)
+            else:
+                self._update(chunks)
+        finally:
+            # the pooled Snowflake sessions aren't needed once the load is done
+            self.snowflake_hook.close_pool()
 
 class SnowflakeToDynamoBookmarkOperator(SnowflakeToDynamoOperator):
     template_fields = ['snowflake_query', 'ttl_timestamp', 'bookmark_s3_key']
@@ -260,14 +381,29 @@ class SnowflakeToDynamoBookmarkOperator(SnowflakeToDynamoOperator):
         self.incremental_key = incremental_key
         self.incremental_key_type = incremental_key_type
         self.bookmark_s3_key = bookmark_s3_key
+        self._next_bookmark = None
+
+    def _generate_chunks(self):
+        """
+        Generate the query results like SnowflakeToDynamoOperator, taking the next
+        bookmark from the bookmark column added to the query and dropping that
+        column before the rows are loaded.
+        """
+        for df in super()._generate_chunks():
+            if self._next_bookmark is None and len(df):
+                self._next_bookmark = df[BOOKMARK_COLUMN].iloc[0]
+            yield df.drop(columns=BOOKMARK_COLUMN)
 
     def execute(self, context):
         s3_bookmark_hook = S3BookmarkHook(bookmark_s3_key=self.bookmark_s3_key, incremental_key_type=self.incremental_key_type)
         latest_bookmark = s3_bookmark_hook.get_latest_bookmark()
-        self.snowflake_query = f'with inner_cte as ({self.snowflake_query}) select * from inner_cte where {self.incremental_key} > {latest_bookmark}'
-        bookmark_query = f'with outer_cte as ({self.snowflake_query}) select max({self.incremental_key}) as "bookmark" from outer_cte'
-        next_bookmark = self.snowflake_hook.run(sql=bookmark_query, handler=lambda cursor: cursor.fetchall())[0]['bookmark']
+        # the next bookmark comes back with every row, so Snowflake only compiles and runs one query
+        self.snowflake_query = (
+            f'with inner_cte as ({self.snowflake_query}) '
+            f'select *, max({self.incremental_key}) over () as "{BOOKMARK_COLUMN}" from inner_cte where {self.incremental_key} > {latest_bookmark}'
+        )
+        self._next_bookmark = None
 
         super().execute(context)
 
-        s3_bookmark_hook.save_next_bookmark(next_bookmark) 
+        s3_bookmark_hook.save_next_bookmark(self._next_bookmark)
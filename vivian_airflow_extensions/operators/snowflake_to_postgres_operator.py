@@ -1,14 +1,31 @@
+import dataclasses
+import os
+import queue
+import threading
+from functools import cached_property
 from typing import List
-from tempfile import NamedTemporaryFile
 
 from airflow.models.baseoperator import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
 from ..hooks.extended_snowflake_hook import ExtendedSnowflakeHook
-from ..hooks.extended_postgres_hook import ExtendedPostgresHook
+from ..hooks.extended_postgres_hook import ExtendedPostgresHook, _quote_identifier
 from ..hooks.s3_bookmark_hook import S3BookmarkHook
 
+BOOKMARK_COLUMN = '_airflow_bookmark'
+
+
+@dataclasses.dataclass(frozen=True)
+class _SqlClauses:
+    """
+    The quoted column lists and clauses used to build the load statements.
+    """
+    columns_string: str
+    column_list: str = ''
+    on_conflict_clause: str = ''
+    conditional_timestamp_clause: str = ''
+
 
 class SnowflakeToPostgresOperator(BaseOperator): 
     """
@@ -19,7 +36,8 @@ class SnowflakeToPostgresOperator(BaseOperator):
 
     @apply_defaults
     def __init__(self, postgres_table: str=None, snowflake_query: str=None, array_fields: list=[], snowflake_conn_id='snowflake_default', 
-                 postgres_conn_id='postgres_default', schema: str='public', include_autoincrement_keys=False, *args, **kwargs) -> None:
+                 postgres_conn_id='postgres_default', schema: str='public', include_autoincrement_keys=False, use_stage_export: bool=False,
+                 small_table_threshold_rows: int=100_000, use_binary_copy: bool=False, *args, **kwargs) -> None:
         """
         Initialize a new instance of SnowflakeToPostgresOperator.
 
@@ -28,6 +46,16 @@ class SnowflakeToPostgresOperator(BaseOperator):
         :param array_fields: The fields to treat as arrays.
         :param snowflake_conn_id: The ID of the Snowflake connection to use.
         :param postgres_conn_id: The ID of the Postgres connection to use.
+        :param use_stage_export: If True, unload the query results through the
+            Snowflake user stage with COPY INTO instead of fetching them row by row.
+            Much faster for large results. Defaults to False.
+        :param small_table_threshold_rows: Results with at most this many rows are
+            fetched into memory and copied straight into Postgres in one go. Larger
+            results are streamed from the same query, so it only runs once. Set to
+            0 to always stream. Not used with use_stage_export. Defaults to 100,000.
+        :param use_binary_copy: If True, stream the fetched rows into Postgres with a
+            binary COPY instead of going through CSV. Doesn't support array columns.
+            Defaults to False.
         """
         super().__init__(*args, **kwargs)
 
@@ -47,30 +75,135 @@ class SnowflakeToPostgresOperator(BaseOperator):
         self.postgres_hook = ExtendedPostgresHook(postgres_conn_id=self.postgres_conn_id, pool_pre_ping=True)
         self.metadata_retrieved = False
         self.include_autoincrement_keys = include_autoincrement_keys
+        self.use_stage_export = use_stage_export
+        self.small_table_threshold_rows = small_table_threshold_rows
+        self.use_binary_copy = use_binary_copy
 
-    def execute(self, context):
-        with NamedTemporaryFile('w+') as file:
-            self.log.info('START get snowflake data')
-            new_data = self.snowflake_hook.save_snowflake_results_to_tmp_file(self.snowflake_query, self.array_fields, file, 'postgres')
-            if not new_data:
-                self.log.info('Query returned no data, exiting')
-                return
+    def _get_columns_list(self):
+        """
+        Return the columns of the Postgres table, reading the table metadata only
+        the first time it's needed. The hook caches the metadata across tasks too.
+        """
+        if not self.metadata_retrieved:
+            self.columns_list = self.postgres_hook.get_table_metadata(self.postgres_table, self.schema, self.include_autoincrement_keys)
+            self.metadata_retrieved = True
+        return self.columns_list
+
+    def _build_clauses(self):
+        return _SqlClauses(columns_string=', '.join(map(_quote_identifier, self._get_columns_list())))
+
+    @cached_property
+    def _sql_clauses(self):
+        """
+        The SQL clauses for this table, built from its metadata the first time
+        they're needed.
+        """
+        return self._build_clauses()
+
+    def _prepare_rows(self, rows):
+        """
+        Adjust a chunk of fetched rows before it's copied into Postgres. Returns the
+        rows unchanged; subclasses override it.
+        """
+        return rows
+
+    def _stream_stage_export_to_db(self, columns_string, tmp_table):
+        """
+        Stream the Snowflake stage export straight into the Postgres table.
+
+        A background thread writes the unloaded CSV files into one end of an OS pipe while
+        COPY reads from the other end, so the export and load run at the same time.
+        Errors raised by the export thread are passed back through a queue and
+        re-raised here.
+
+        :param columns_string: The columns to write the data to.
+        :param tmp_table: The table to write the data to.
+
+        :return: True if the query returned any rows, False otherwise.
+        """
+        read_fd, write_fd = os.pipe()
+        pipe_read = os.fdopen(read_fd, 'rb')
+        pipe_write = os.fdopen(write_fd, 'w')
+        results = queue.Queue()
+        errors = queue.Queue()
+
+        def export():
+            try:
+                results.put(self.snowflake_hook.save_via_stage(self.snowflake_query, self.array_fields, pipe_write, 'postgres'))
+            except BaseException as e:
+                errors.put(e)
+            finally:
+                try:
+                    pipe_write.close()
+                except BrokenPipeError:
+                    # COPY already stopped reading; its own error is raised instead
+                    pass
+
+        export_thread = threading.Thread(target=export, name=f'{self.task_id}-snowflake-export', daemon=True)
+        export_thread.start()
+        try:
+            self.postgres_hook.write_to_db(pipe_read, columns_string, tmp_table)
+        finally:
+            # Closing the read end unblocks the export thread if COPY failed
+            pipe_read.close()
+            export_thread.join()
+
+        if not errors.empty():
+            raise errors.get()
+        return results.get()
 
+    def execute(self, context):
+        small_rows = row_chunks = None
+        try:
             self.log.info('START get column list')
-            if not self.metadata_retrieved:
-                self.columns_list = self.postgres_hook.get_table_metadata(self.postgres_table, self.schema, self.include_autoincrement_keys)
-                self.metadata_retrieved = True
-            columns_string = ", ".join([f'"{col}"' for col in self.columns_list])
+            columns_string = self._sql_clauses.columns_string
+
+            # COPY INTO can't be answered from the result cache, so probing first would run a stage export twice
+            if self.small_table_threshold_rows and not self.use_stage_export:
+                # a larger result is streamed from the cursor the probe already ran, so the query only runs once
+                small_rows, row_chunks = self.snowflake_hook.fetch_all_if_small(self.snowflake_query, self.array_fields, self.small_table_threshold_rows, 'postgres')
+                # an empty result is known before anything is written, so the tmp table is never created
+                if small_rows is not None and not small_rows:
+                    self.log.info('Query returned no data, exiting')
+                    return
 
             self.log.info('START create tmp table')
-            self.postgres_hook.create_tmp_table(self.postgres_table)        
+            self.postgres_hook.create_tmp_table(self.postgres_table)
 
-            self.log.info('START write to DB')
             tmp_table = f'Tmp{self.postgres_table}'
-            self.postgres_hook.write_to_db(file, columns_string, tmp_table)
+            if small_rows is not None:
+                self.log.info('START copy snowflake rows to DB')
+                rows = self._prepare_rows(small_rows)
+                self.postgres_hook.copy_rows_direct(rows, columns_string, tmp_table)
+                new_data = True
+            elif self.use_binary_copy:
+                self.log.info('START binary copy snowflake data to DB')
+                if row_chunks is None:
+                    row_chunks = (rows for rows, _ in self.snowflake_hook.generate_tuples_from_table(self.snowflake_query))
+                new_data = self.postgres_hook.write_rows_to_db_binary(map(self._prepare_rows, row_chunks), self.columns_list, tmp_table)
+            elif self.use_stage_export:
+                self.log.info('START stream snowflake stage export to DB')
+                new_data = self._stream_stage_export_to_db(columns_string, tmp_table)
+            else:
+                self.log.info('START stream snowflake data to DB')
+                if row_chunks is None:
+                    row_chunks = self.snowflake_hook.iter_rows(self.snowflake_query, self.array_fields, 'postgres')
+                new_data = self.postgres_hook.copy_from_iter(map(self._prepare_rows, row_chunks), columns_string, tmp_table)
+            if not new_data:
+                self.log.info('Query returned no data, dropping tmp table and exiting')
+                self.postgres_hook.swap_db_tables(self.postgres_table, [])
+                return
+
+            self.log.info('START swap db tables')
+            self.postgres_hook.swap_db_tables(self.postgres_table, self.insert_commands)
+        finally:
+            if row_chunks is not None:
+                # releases the Snowflake connection if the copy stopped early
+                row_chunks.close()
+            # the pooled sessions aren't needed once the load is done
+            self.snowflake_hook.close_pool()
+            self.postgres_hook.close_pool()
 
-        self.log.info('START swap db tables')
-        self.postgres_hook.swap_db_tables(self.postgres_table, self.insert_commands)
 
 class SnowflakeToPostgresMergeIncrementalOperator(SnowflakeToPostgresOperator):
     """
@@ -116,44 +249,62 @@ class SnowflakeToPostgresMergeIncrementalOperator(SnowflakeToPostgresOperator):
                             " is missing."
                         )
 
-    def execute(self, context):
-        # this if/else statement assigns the on conflict clause, if any
-        if self.primary_key_columns is None:
-            on_conflict_clause = ''
-            conditional_timestamp_clause = ''
-        else:
+    def _build_clauses(self):
+        clauses = super()._build_clauses()
+
+        # assigns the on conflict clause, if any
+        if self.primary_key_columns is not None:
             if self.columns_to_update is None:
-                self.columns_list = self.postgres_hook.get_table_metadata(self.postgres_table, self.schema, self.include_autoincrement_keys)
-                self.metadata_retrieved = True
-                self.columns_to_update = [col for col in self.columns_list if col not in self.primary_key_columns]
+                self.columns_to_update = [col for col in self._get_columns_list() if col not in self.primary_key_columns]
             self._validate_insert_only_columns()
 
+            table = _quote_identifier(self.postgres_table)
             columns_to_update_array = []
             for column in self.columns_to_update:
+                quoted = _quote_identifier(column)
                 if self.insert_only_columns is not None and column in self.insert_only_columns:
-                    line = f'"{column}"=coalesce("{self.postgres_table}"."{column}", excluded."{column}")'
+                    line = f'{quoted}=coalesce({table}.{quoted}, excluded.{quoted})'
                 else:
-                    line = f'"{column}"=excluded."{column}"'
+                    line = f'{quoted}=excluded.{quoted}'
                 columns_to_update_array.append(line)
-            columns_to_update_string = ", ".join(columns_to_update_array)
-            primary_key_columns_string = ", ".join(['"' + col + '"' for col in self.primary_key_columns])
-            on_conflict_clause = f'on conflict({primary_key_columns_string}) do update set {columns_to_update_string}'
+            columns_to_update_string = ', '.join(columns_to_update_array)
+            primary_key_columns_string = ', '.join(map(_quote_identifier, self.primary_key_columns))
+            clauses = dataclasses.replace(clauses, on_conflict_clause=f'on conflict({primary_key_columns_string}) do update set {columns_to_update_string}')
 
             if self.conditional_psql_timestamp_column is not None:
-                conditional_timestamp_clause = f'where excluded."{self.conditional_psql_timestamp_column}" >= "{self.postgres_table}"."{self.conditional_psql_timestamp_column}"'
+                timestamp_column = _quote_identifier(self.conditional_psql_timestamp_column)
+                clauses = dataclasses.replace(
+                    clauses,
+                    conditional_timestamp_clause=f'where excluded.{timestamp_column} >= {table}.{timestamp_column}',
+                )
+
+        if self.columns_to_update is not None:
+            if self.include_autoincrement_keys:
+                column_list = ', '.join(map(_quote_identifier, self.columns_to_update))
             else:
-                conditional_timestamp_clause = ''
+                column_list = ', '.join(map(_quote_identifier, self.columns_to_update + (self.primary_key_columns or [])))
+            clauses = dataclasses.replace(clauses, column_list=column_list)
 
-        tmp_table = f'Tmp{self.postgres_table}'
+        return clauses
 
+    @cached_property
+    def _insert_commands(self):
+        """
+        The commands that merge the tmp table into the Postgres table, built the
+        first time they're needed.
+        """
+        clauses = self._sql_clauses
+        table = _quote_identifier(self.postgres_table)
+        tmp_table = _quote_identifier(f'Tmp{self.postgres_table}')
+
+        # _sql_clauses fills in columns_to_update from the metadata when it isn't given
         if self.columns_to_update is None:
-            self.insert_commands = [f'insert into "{self.postgres_table}" select * from "{tmp_table}" {on_conflict_clause};']
-        else:
-            if self.include_autoincrement_keys:
-                column_list = ', '.join(['"' + col + '"' for col in self.columns_to_update])
-            else:
-                column_list = ', '.join(['"' + col + '"' for col in self.columns_to_update + self.primary_key_columns])
-            self.insert_commands = [f'insert into "{self.postgres_table}" ({column_list}) select {column_list} from "{tmp_table}" {on_conflict_clause} {conditional_timestamp_clause};']
+            return [f'insert into {table} select * from {tmp_table} {clauses.on_conflict_clause};']
+        return [f'insert into {table} ({clauses.column_list}) select {clauses.column_list} from {tmp_table} {clauses.on_conflict_clause} {clauses.conditional_timestamp_clause};']
+
+    def execute(self, context):
+        # a copy, so nothing appended to it for this run changes the cached commands
+        self.insert_commands = list(self._insert_commands)
 
         super().execute(context)
 
@@ -185,16 +336,35 @@ class SnowflakeToPostgresBookmarkOperator(SnowflakeToPostgresMergeIncrementalOpe
         self.incremental_key = incremental_key
         self.incremental_key_type = incremental_key_type
         self.bookmark_s3_key = bookmark_s3_key
+        self._next_bookmark = None
+
+    def _prepare_rows(self, rows):
+        """
+        Take the next bookmark from the window column the query adds to every row,
+        and drop that column before the rows are copied.
+        """
+        if self._next_bookmark is None and rows:
+            self._next_bookmark = rows[0][-1]
+        return [row[:-1] for row in rows]
 
     def execute(self, context):
         self.s3_bookmark_hook = S3BookmarkHook(bookmark_s3_key=self.bookmark_s3_key, incremental_key_type=self.incremental_key_type)
 
         latest_bookmark = self.s3_bookmark_hook.get_latest_bookmark()
-        self.snowflake_query = f'with inner_cte as ({self.snowflake_query}) select * from inner_cte where {self.incremental_key} > {latest_bookmark}'
-        self.bookmark_query = f'with outer_cte as ({self.snowflake_query}) select max({self.incremental_key}) as "bookmark" from outer_cte'
-        next_bookmark = self.snowflake_hook.run(sql=self.bookmark_query, handler=lambda cursor: cursor.fetchall())[0]['bookmark']
+        self._next_bookmark = None
+        if self.use_stage_export:
+            # the unloaded files go straight to COPY, so the bookmark can't ride along in the rows
+            self.snowflake_query = f'with inner_cte as ({self.snowflake_query}) select * from inner_cte where {self.incremental_key} > {latest_bookmark}'
+            self.bookmark_query = f'with outer_cte as ({self.snowflake_query}) select max({self.incremental_key}) as "bookmark" from outer_cte'
+            self._next_bookmark = self.snowflake_hook.run(sql=self.bookmark_query, handler=lambda cursor: cursor.fetchall())[0]['bookmark']
+        else:
+            self.snowflake_query = (
+                f'with inner_cte as ({self.snowflake_query}) '
+                f'select *, max({self.incremental_key}) over () as "{BOOKMARK_COLUMN}" from inner_cte where {self.incremental_key} > {latest_bookmark}'
+            )
 
         super().execute(context)
+        next_bookmark = self._next_bookmark
 
         self.s3_bookmark_hook.save_next_bookmark(next_bookmark)
 
@@ -206,5 +376,6 @@ class SnowflakeToPostgresBookmarkOperator(SnowflakeToPostgresMergeIncrementalOpe
         self.xcom_push(
             context,
             key='next_bookmark',
-            value=next_bookmark.strftime(self.s3_bookmark_hook.format_string)
+            # no bookmark when the query found no new rows
+            value=self.s3_bookmark_hook.format_bookmark(next_bookmark) if next_bookmark is not None else None
         )
@@ -1,10 +1,11 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from airflow.models.baseoperator import BaseOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
 from ..hooks.stitch_hook import StitchHook
+from ..triggers.stitch_trigger import StitchStatusTrigger
 
 
 class StitchRunSourceOperator(BaseOperator): 
@@ -44,17 +45,19 @@ class StitchRunSourceOperator(BaseOperator):
 
 class StitchRunAndMonitorSourceOperator(StitchRunSourceOperator): 
     @apply_defaults
-    def __init__(self, sleep_time=300, timeout=86400, *args, **kwargs) -> None:
+    def __init__(self, sleep_time=300, timeout=86400, deferrable: bool=False, *args, **kwargs) -> None:
         """
         Initialize a new instance of StitchRunAndMonitorSourceOperator.
 
-        :param sleep_time: The time to sleep between checks.
+        :param sleep_time: The longest time to sleep between checks; the wait backs off up to it.
         :param timeout: The maximum time to wait for the source to finish running.
+        :param deferrable: Wait in the triggerer instead of a worker slot, checking every sleep_time.
         """
         super().__init__(*args, **kwargs)
 
         self.sleep_time = sleep_time
         self.timeout = timeout
+        self.deferrable = deferrable
 
     def execute(self, context):
         tic = datetime.now()
@@ -62,4 +65,17 @@ class StitchRunAndMonitorSourceOperator(StitchRunSourceOperator):
         super().execute(context)
 
         self.log.info(f'Monitoring source: source_id = {self.source_id}')
+        if self.deferrable:
+            self.defer(
+                trigger=StitchStatusTrigger(source_id=self.source_id, client_id=self.client_id, conn_id=self.conn_id, start_time=tic, poll_interval=self.sleep_time),
+                method_name='execute_complete',
+                timeout=timedelta(seconds=self.timeout),
+            )
+
         self.stitch_hook.monitor_extraction(sleep_time=self.sleep_time, timeout=self.timeout, source_id=self.source_id, client_id=self.client_id, start_time=tic)
+
+    def execute_complete(self, context, event=None):
+        if event['status'] == 'error':
+            raise AirflowException(event['message'])
+
+        self.log.info(f'Extraction succeeded: source_id = {self.source_id}')
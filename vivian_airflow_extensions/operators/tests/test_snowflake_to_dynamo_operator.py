@@ -1,31 +1,32 @@
-import unittest
 import time
 from datetime import datetime
-from unittest import mock
 from unittest.mock import patch, MagicMock
 from decimal import Decimal
 
+import pandas as pd
+import pytest
 from airflow.exceptions import AirflowException
 from moto import mock_dynamodb
 from pynamodb.models import Model
 from pynamodb.attributes import UnicodeAttribute
+from tenacity import wait_none
 from airflow.models import DAG
 
 from vivian_airflow_extensions.operators.snowflake_to_dynamo_operator import SnowflakeToDynamoOperator, SnowflakeToDynamoBookmarkOperator
 
 
-def clean_func(row_dict, model_columns):
-    for key, value in row_dict.items():
-        if isinstance(value, Decimal):
-            # Convert Decimal to float, then to string
-            row_dict[key] = str(float(value))
-        elif isinstance(value, datetime):
-            # Convert datetime object to string
-            row_dict[key] = value.strftime("%Y-%m-%dT%H:%M:%S")
-        elif isinstance(value, int):
-            # Convert int to string
-            row_dict[key] = str(value)
-    return row_dict
+def clean_batch(df):
+    # the same conversions as a per-row cleaning_function, a column at a time
+    for column in df.columns:
+        if pd.api.types.is_float_dtype(df[column]):
+            # Decimals arrive as floats; convert to string
+            df[column] = df[column].astype(str).where(df[column].notna())
+        elif pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = df[column].dt.strftime("%Y-%m-%dT%H:%M:%S")
+        elif pd.api.types.is_integer_dtype(df[column]):
+            df[column] = df[column].astype(str)
+    return df
+
 
 class MockModel(Model):
     class Meta:
@@ -35,34 +36,27 @@ class MockModel(Model):
     value = UnicodeAttribute()
     updatedAt = UnicodeAttribute()
 
-class TestSnowflakeToDynamoOperator(unittest.TestCase):
-    @mock.patch('vivian_airflow_extensions.operators.snowflake_to_dynamo_operator.ExtendedSnowflakeHook')
-    def setUp(self, MockSnowflakeHook):
-        self.snowflake_hook = MockSnowflakeHook()
-        self.snowflake_hook.get_conn.return_value = mock.MagicMock()
-        self.dag = DAG('test_dag', start_date=datetime.now())
-        self.operator = SnowflakeToDynamoOperator(
-            task_id='test_task',
-            dynamo_model=MockModel,
-            snowflake_query='SELECT * FROM table',
-            dag=self.dag,
-            cleaning_function=clean_func
-        )
 
-    def test_init(self):
-        self.assertEqual(self.operator.dynamo_model, MockModel)
-        self.assertEqual(self.operator.snowflake_query, 'SELECT * FROM table')
-        self.assertEqual(self.operator.snowflake_conn_id, 'snowflake_default')
+@pytest.fixture
+def snowflake_hook():
+    with patch('vivian_airflow_extensions.operators.snowflake_to_dynamo_operator.ExtendedSnowflakeHook') as m:
+        yield m.return_value
 
-    def test_convert_nan(self):
-        self.assertIsNone(self.operator._convert_nan(float('nan')))
-        self.assertEqual(self.operator._convert_nan(1), 1)
 
-    def test_camel_case(self):
-        self.assertEqual(self.operator._camel_case('test_string'), 'testString')
+@pytest.fixture
+def operator(snowflake_hook):
+    return SnowflakeToDynamoOperator(
+        task_id='test_task',
+        dynamo_model=MockModel,
+        snowflake_query='SELECT * FROM table',
+        dag=DAG('test_dag', start_date=datetime.now()),
+        batch_cleaning_function=clean_batch
+    )
 
-    @mock_dynamodb
-    def test_execute(self):
+
+@pytest.fixture
+def mock_table():
+    with mock_dynamodb():
         MockModel.create_table(
             read_capacity_units=1,
             write_capacity_units=1,
@@ -72,43 +66,210 @@ class TestSnowflakeToDynamoOperator(unittest.TestCase):
         # Add a delay to give DynamoDB time to make the table available
         time.sleep(5)
 
-        self.snowflake_hook.generate_rows_from_table.return_value = iter([({'id': 1, 'value': str(Decimal('10.5'))}, ['id', 'value'])])
-        self.operator.execute({})
-        self.snowflake_hook.generate_rows_from_table.assert_called_once_with('SELECT * FROM table', 10000)
+        yield MockModel
 
-    @mock_dynamodb
-    def test_query_by_id(self):
-        # Create the table
-        MockModel.create_table(
-            read_capacity_units=1,
-            write_capacity_units=1,
-            wait=True
-        )
+        MockModel.delete_table()
 
-        # Add a delay to give DynamoDB time to make the table available
-        time.sleep(5)
 
-        # Mock the generate_rows_from_table method to return a row with id='1' and value='10.5'
-        self.snowflake_hook.generate_rows_from_table.return_value = iter([({'id': '1', 'value': '10.5'}, ['id', 'value'])])
+def test_init(operator):
+    assert operator.dynamo_model == MockModel
+    assert operator.snowflake_query == 'SELECT * FROM table'
+    assert operator.snowflake_conn_id == 'snowflake_default'
+    assert operator._model_keys == ('id',)
+    assert sorted(operator._non_key_attrs) == ['updatedAt', 'value']
 
-        # Execute the operator to insert the row
-        self.operator.execute({})
 
-        # Query the table by id
-        results = list(MockModel.query('1'))
+def test_convert_nan(operator):
+    assert operator._convert_nan(float('nan')) is None
+    assert operator._convert_nan(1) == 1
 
-        # Assert that the query returned the correct result
-        self.assertEqual(len(results), 1)
-        self.assertEqual(results[0].id, '1')
-        self.assertEqual(results[0].value, '10.5')
 
-        # Delete the table
-        MockModel.delete_table()
+def test_clean_row(operator):
+    row = {'id': 1, 'name': 'a'}
+    assert operator._clean_row(row) is row
+
+    operator.cleaning_function = lambda row_dict, columns: {**row_dict, 'name': float('nan')}
+    assert operator._clean_row(row) == {'id': 1, 'name': None}
+
+
+def test_camel_case(operator):
+    assert operator._camel_case('test_string') == 'testString'
+
+
+def test_format_chunk(operator):
+    operator.batch_cleaning_function = None
+    operator.json_fields = ['payload']
+    updated_at = datetime(2022, 1, 1)
+    df = pd.DataFrame([
+        ('1', Decimal('10.5'), '{"a": 1}', 2.0),
+        ('2', None, None, float('nan')),
+    ], columns=['ID', 'SOME_VALUE', 'PAYLOAD', 'SCORE'])
+
+    records = operator._format_chunk(df, updated_at)
+
+    assert records == [
+        {'id': '1', 'someValue': 10.5, 'payload': {'a': 1}, 'score': 2.0, 'updatedAt': updated_at},
+        {'id': '2', 'someValue': None, 'payload': None, 'score': None, 'updatedAt': updated_at},
+    ]
+
+
+def test_format_chunk_null_int(operator):
+    operator.batch_cleaning_function = None
+    operator.add_updated_at = False
+    # built the way generate_dataframes_from_table builds chunks from the cursor
+    df = pd.DataFrame([(2 ** 53 + 1,), (None,)], columns=['COUNT'], dtype=object)
+
+    records = operator._format_chunk(df, datetime(2022, 1, 1))
+
+    # still an exact int, not a float
+    assert records == [{'count': 2 ** 53 + 1}, {'count': None}]
+    assert type(records[0]['count']) is int
+
+
+def test_format_chunk_batch_cleaning_function(operator):
+    updated_at = datetime(2022, 1, 1)
+    df = pd.DataFrame({
+        'ID': [1, 2],
+        'VALUE': [Decimal('10.5'), None],
+        'SEEN_AT': pd.to_datetime(['2022-01-01 10:00:00', '2022-01-02 11:30:00']),
+    })
+
+    records = operator._format_chunk(df, updated_at)
+
+    assert records == [
+        {'id': '1', 'value': '10.5', 'seenAt': '2022-01-01T10:00:00', 'updatedAt': updated_at},
+        {'id': '2', 'value': None, 'seenAt': '2022-01-02T11:30:00', 'updatedAt': updated_at},
+    ]
+
+
+def test_format_chunk_decimal_columns(operator):
+    operator.batch_cleaning_function = None
+    df = pd.DataFrame([('1', None), ('2', None)], columns=['ID', 'AMOUNT'])
+    operator._format_chunk(df, datetime(2022, 1, 1))
+
+    # AMOUNT has no values yet, so it is checked again on the next chunk
+    assert operator._decimal_columns == []
+
+    df = pd.DataFrame([('3', Decimal('1.25')), ('4', None)], columns=['ID', 'AMOUNT'])
+    records = operator._format_chunk(df, datetime(2022, 1, 1))
+
+    assert operator._decimal_columns == ['amount']
+    assert [record['amount'] for record in records] == [1.25, None]
+
 
+@patch.object(SnowflakeToDynamoOperator, '_update_record')
+def test_update(mock_update_record, operator):
+    operator.update_parallelism = 2
+    df = pd.DataFrame([(str(i), str(i * 10)) for i in range(10)], columns=['ID', 'VALUE'])
 
-class TestSnowflakeToDynamoBookmarkOperator(unittest.TestCase):
-    def setUp(self):
-        self.operator = SnowflakeToDynamoBookmarkOperator(
+    operator._update(iter([df]))
+
+    assert mock_update_record.call_count == 10
+    assert sorted(call[0][0].id for call in mock_update_record.call_args_list) == sorted(str(i) for i in range(10))
+
+
+def test_update_record_retries(operator):
+    record = MagicMock()
+    record.update.side_effect = [Exception('Throttled'), None]
+    update_record = SnowflakeToDynamoOperator._update_record.retry_with(wait=wait_none())
+
+    update_record(operator, record, ['action'], {'id': '1'})
+
+    assert record.update.call_count == 2
+
+
+def test_update_record_gives_up(operator):
+    record = MagicMock()
+    record.update.side_effect = Exception('Throttled')
+    update_record = SnowflakeToDynamoOperator._update_record.retry_with(wait=wait_none())
+
+    with pytest.raises(Exception, match='Throttled'):
+        update_record(operator, record, ['action'], {'id': '1'})
+
+    assert record.update.call_count == 3
+
+
+def test_execute(operator, snowflake_hook, mock_table):
+    snowflake_hook.generate_dataframes_from_table.return_value = iter([pd.DataFrame([(1, str(Decimal('10.5')))], columns=['id', 'value'])])
+    operator.execute({})
+    snowflake_hook.generate_dataframes_from_table.assert_called_once_with('SELECT * FROM table', 10000, use_arrow=False)
+
+
+def test_query_by_id(operator, snowflake_hook, mock_table):
+    # Mock the generate_dataframes_from_table method to return a row with id='1' and value='10.5'
+    snowflake_hook.generate_dataframes_from_table.return_value = iter([pd.DataFrame([('1', '10.5')], columns=['id', 'value'])])
+
+    # Execute the operator to insert the row
+    operator.execute({})
+
+    # Query the table by id
+    results = list(MockModel.query('1'))
+
+    # Assert that the query returned the correct result
+    assert len(results) == 1
+    assert results[0].id == '1'
+    assert results[0].value == '10.5'
+
+
+@pytest.fixture
+def bookmark_operator(snowflake_hook):
+    return SnowflakeToDynamoBookmarkOperator(
+        task_id='test_task',
+        dynamo_model=MockModel,
+        snowflake_query='SELECT * FROM table',
+        incremental_key='test_key',
+        incremental_key_type='int',
+        bookmark_s3_key='s3://test_bucket/test_key'
+    )
+
+
+@pytest.fixture
+def mock_s3_bookmark_hook():
+    with patch('vivian_airflow_extensions.operators.snowflake_to_dynamo_operator.S3BookmarkHook') as m:
+        yield m.return_value
+
+
+def test_bookmark_init(bookmark_operator):
+    assert bookmark_operator.incremental_key == 'test_key'
+    assert bookmark_operator.incremental_key_type == 'int'
+    assert bookmark_operator.bookmark_s3_key == 's3://test_bucket/test_key'
+
+
+@patch.object(SnowflakeToDynamoOperator, '_insert')
+def test_bookmark_execute(mock_insert, bookmark_operator, snowflake_hook, mock_s3_bookmark_hook):
+    mock_s3_bookmark_hook.get_latest_bookmark.return_value = 1
+    snowflake_hook.generate_dataframes_from_table.return_value = iter([
+        pd.DataFrame([('2', 'a', 3), ('3', 'b', 3)], columns=['ID', 'VALUE', '_airflow_bookmark']),
+    ])
+    loaded = []
+    mock_insert.side_effect = lambda chunks: loaded.extend(chunks)
+
+    bookmark_operator.execute(None)
+
+    # one query returns both the rows and the next bookmark
+    assert bookmark_operator.snowflake_query == (
+        'with inner_cte as (SELECT * FROM table) '
+        'select *, max(test_key) over () as "_airflow_bookmark" from inner_cte where test_key > 1'
+    )
+    snowflake_hook.run.assert_not_called()
+    assert list(loaded[0].columns) == ['ID', 'VALUE']
+    mock_s3_bookmark_hook.save_next_bookmark.assert_called_once_with(3)
+
+
+@patch.object(SnowflakeToDynamoOperator, '_insert')
+def test_bookmark_execute_no_rows(mock_insert, bookmark_operator, snowflake_hook, mock_s3_bookmark_hook):
+    mock_s3_bookmark_hook.get_latest_bookmark.return_value = 1
+    snowflake_hook.generate_dataframes_from_table.return_value = iter([])
+    mock_insert.side_effect = lambda chunks: list(chunks)
+
+    bookmark_operator.execute(None)
+
+    mock_s3_bookmark_hook.save_next_bookmark.assert_called_once_with(None)
+
+
+def test_bookmark_init_invalid_incremental_key_type():
+    with pytest.raises(AirflowException):
+        SnowflakeToDynamoBookmarkOperator(
             task_id='test_task',
             snowflake_conn_id='test_snowflake_conn',
             dynamo_conn_id='test_dynamo_conn',
@@ -116,48 +277,6 @@ class TestSnowflakeToDynamoBookmarkOperator(unittest.TestCase):
             snowflake_table='test_table',
             dynamo_table='test_dynamo_table',
             incremental_key='test_key',
-            incremental_key_type='int',
+            incremental_key_type='invalid',
             bookmark_s3_key='s3://test_bucket/test_key'
         )
-
-    def test_init(self):
-        self.assertEqual(self.operator.incremental_key, 'test_key')
-        self.assertEqual(self.operator.incremental_key_type, 'int')
-        self.assertEqual(self.operator.bookmark_s3_key, 's3://test_bucket/test_key')
-
-    @patch('your_module.S3BookmarkHook')  # replace with the actual module
-    def test_execute(self, mock_s3_bookmark_hook):
-        mock_s3_bookmark_hook.return_value.get_latest_bookmark.return_value = 1
-        mock_s3_bookmark_hook.return_value.save_next_bookmark.return_value = None
-        self.operator.snowflake_hook = MagicMock()
-        self.operator.snowflake_hook.run.return_value = [{'bookmark': 2}]
-        self.operator.execute(None)
-        self.assertIn('where test_key > 1', self.operator.snowflake_query)
-        mock_s3_bookmark_hook.return_value.save_next_bookmark.assert_called_once_with(2)
-
-    @patch('your_module.S3BookmarkHook')  # replace with the actual module
-    def test_execute_no_bookmark(self, mock_s3_bookmark_hook):
-        mock_s3_bookmark_hook.return_value.get_latest_bookmark.return_value = None
-        mock_s3_bookmark_hook.return_value.save_next_bookmark.return_value = None
-        self.operator.snowflake_hook = MagicMock()
-        self.operator.snowflake_hook.run.return_value = [{'bookmark': 2}]
-        self.operator.execute(None)
-        self.assertIn('where test_key > ', self.operator.snowflake_query)  # Check that the query uses the default value
-        mock_s3_bookmark_hook.return_value.save_next_bookmark.assert_called_once_with(2)
-
-    def test_init_invalid_incremental_key_type(self):
-        with self.assertRaises(AirflowException):
-            SnowflakeToDynamoBookmarkOperator(
-                task_id='test_task',
-                snowflake_conn_id='test_snowflake_conn',
-                dynamo_conn_id='test_dynamo_conn',
-                snowflake_database='test_db',
-                snowflake_table='test_table',
-                dynamo_table='test_dynamo_table',
-                incremental_key='test_key',
-                incremental_key_type='invalid',
-                bookmark_s3_key='s3://test_bucket/test_key'
-            )
-
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
@@ -1,92 +1,299 @@
-import unittest
-from datetime import datetime
-from unittest.mock import patch, ANY
+import functools
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock, ANY
 
+import pytest
 from airflow.models import DAG
 
+from vivian_airflow_extensions.hooks.extended_postgres_hook import ExtendedPostgresHook
 from vivian_airflow_extensions.operators.snowflake_to_postgres_operator import SnowflakeToPostgresOperator
+from vivian_airflow_extensions.operators.snowflake_to_postgres_operator import SnowflakeToPostgresMergeIncrementalOperator
 from vivian_airflow_extensions.operators.snowflake_to_postgres_operator import SnowflakeToPostgresBookmarkOperator
 
-class TestSnowflakeToPostgresOperator(unittest.TestCase):
-    def setUp(self):
-        self.dag = DAG(dag_id='test_dag', start_date=datetime.now())
-        with patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedSnowflakeHook') as self.mock_snowflake_hook, \
-             patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedPostgresHook') as self.mock_postgres_hook:
-            self.operator = SnowflakeToPostgresOperator(
-                task_id='test_task',
-                snowflake_query='SELECT * FROM table',
-                postgres_table='postgres_table',
-                array_fields=['column2'],
-                dag = self.dag
-            )
-
-    def test_execute(self):
-        # Mock the Snowflake hook and its methods
-        self.mock_snowflake_hook.return_value.generate_rows_from_table.return_value = iter([
-            ({'column1': 1, 'column2': 'data1'}, ['column1', 'column2']),
-            ({'column1': 2, 'column2': 'data2'}, ['column1', 'column2']),
-        ])
-
-        # Execute the operator
-        self.operator.execute({})
-
-        # Assert the expected interactions with Snowflake hook
-        self.mock_snowflake_hook.assert_called_once_with(snowflake_conn_id='snowflake_default', pool_pre_ping=True)
-        self.mock_snowflake_hook.return_value.save_snowflake_results_to_tmp_file.assert_any_call(self.operator.snowflake_query, self.operator.array_fields, ANY, 'postgres')
-
-        # Assert the expected interactions with Postgres hook
-        self.mock_postgres_hook.assert_called_once_with(postgres_conn_id='postgres_default', pool_pre_ping=True)
-        self.mock_postgres_hook.return_value.get_table_metadata.assert_called_once_with(self.operator.postgres_table)
-        self.mock_postgres_hook.return_value.create_tmp_table.assert_called_once_with(self.operator.postgres_table)
-        self.mock_postgres_hook.return_value.write_to_db.assert_called_once_with(ANY, ANY, f'Tmp{self.operator.postgres_table}')
-        self.mock_postgres_hook.return_value.swap_db_tables.assert_called_once_with(self.operator.postgres_table)
-
-class TestSnowflakeToPostgresBookmarkOperator(unittest.TestCase):
-    def setUp(self):
-        self.dag = DAG(dag_id='test_dag', start_date=datetime.now())
-        with patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedSnowflakeHook') as self.mock_snowflake_hook, \
-             patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedPostgresHook') as self.mock_postgres_hook, \
-             patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.S3BookmarkHook') as self.mock_s3_bookmark_hook:
-            self.operator = SnowflakeToPostgresBookmarkOperator(
-                task_id="test_task1",
-                postgres_table="my_table",
-                snowflake_query="SELECT * FROM my_snowflake_table",
-                dag=self.dag,
-                primary_key_columns=['id'],
-                incremental_key='updated_at',
-                incremental_key_type='timestamp',
-                bookmark_s3_key='s3://nursefly-airflow/bookmarks/{{ var.value.environment }}/{{ dag.dag_id }}/{{ task.task_id }}/bookmark.txt',
-            )
-    
-    def test_execute(self):
-        # Mock the Snowflake hook
-        self.mock_snowflake_hook.return_value.generate_rows_from_table.return_value = iter([
-            ({'column1': 1, 'column2': 'data1'}, ['column1', 'column2']),
-            ({'column1': 2, 'column2': 'data2'}, ['column1', 'column2']),
-        ])
-
-        # Mock the S3BookmarkHook
-        self.mock_s3_bookmark_hook.return_value.get_latest_bookmark.return_value = '2021-01-11 12:00:00.000'
-
-        # Execute the operator
-        self.operator.execute({})
-
-        # Assert the expected interactions with Snowflake hook
-        self.mock_snowflake_hook.assert_called_once_with(snowflake_conn_id='snowflake_default', pool_pre_ping=True)
-        self.mock_snowflake_hook.return_value.save_snowflake_results_to_tmp_file.assert_any_call(self.operator.snowflake_query, self.operator.array_fields, ANY, 'postgres')
-
-        # Assert the expected interactions with Postgres hook
-        self.mock_postgres_hook.assert_called_once_with(postgres_conn_id='postgres_default', pool_pre_ping=True)
-        self.mock_postgres_hook.return_value.get_table_metadata.assert_called_with(self.operator.postgres_table)
-        self.mock_postgres_hook.return_value.create_tmp_table.assert_called_once_with(self.operator.postgres_table)
-        self.mock_postgres_hook.return_value.write_to_db.assert_called_once_with(ANY, ANY, f'Tmp{self.operator.postgres_table}')
-        self.mock_postgres_hook.return_value.swap_db_tables.assert_called_once_with(self.operator.postgres_table)
-
-        # Assert the generated Snowflake queries
-        expected_snowflake_query = 'with inner_cte as (SELECT * FROM my_snowflake_table) select * from inner_cte where updated_at > 2021-01-11 12:00:00.000'
-        expected_bookmark_query = 'with outer_cte as (with inner_cte as (SELECT * FROM my_snowflake_table) select * from inner_cte where updated_at > 2021-01-11 12:00:00.000) select max(updated_at) as "bookmark" from outer_cte'
-        self.assertEqual(self.operator.snowflake_query, expected_snowflake_query)
-        self.assertEqual(self.operator.bookmark_query, expected_bookmark_query)
-        
-if __name__ == '__main__':
-    unittest.main()
+
+@pytest.fixture
+def dag():
+    return DAG(dag_id='test_dag', start_date=datetime.now())
+
+
+@pytest.fixture
+def mock_snowflake_hook():
+    with patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedSnowflakeHook') as m:
+        yield m
+
+
+@pytest.fixture
+def mock_postgres_hook():
+    with patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.ExtendedPostgresHook') as m:
+        yield m
+
+
+@pytest.fixture
+def mock_s3_bookmark_hook():
+    with patch('vivian_airflow_extensions.operators.snowflake_to_postgres_operator.S3BookmarkHook') as m:
+        yield m
+
+
+@pytest.fixture
+def operator(dag, mock_snowflake_hook, mock_postgres_hook):
+    return SnowflakeToPostgresOperator(
+        task_id='test_task',
+        snowflake_query='SELECT * FROM table',
+        postgres_table='postgres_table',
+        array_fields=['column2'],
+        dag=dag,
+    )
+
+
+@pytest.fixture
+def bookmark_operator(dag, mock_snowflake_hook, mock_postgres_hook, mock_s3_bookmark_hook):
+    return SnowflakeToPostgresBookmarkOperator(
+        task_id="test_task1",
+        postgres_table="my_table",
+        snowflake_query="SELECT * FROM my_snowflake_table",
+        dag=dag,
+        primary_key_columns=['id'],
+        incremental_key='updated_at',
+        incremental_key_type='timestamp',
+        bookmark_s3_key='s3://nursefly-airflow/bookmarks/{{ var.value.environment }}/{{ dag.dag_id }}/{{ task.task_id }}/bookmark.txt',
+    )
+
+
+def test_execute(operator, mock_snowflake_hook, mock_postgres_hook):
+    mock_postgres_hook.return_value.get_table_metadata.return_value = ['column1', 'column2']
+    # over the threshold, the probe hands back the rest of its result instead of the rows
+    mock_snowflake_hook.return_value.fetch_all_if_small.return_value = (None, (rows for rows in [[(1, '{a}')], [(2, '{b}')]]))
+    copied = []
+    mock_postgres_hook.return_value.copy_from_iter.side_effect = lambda row_chunks, columns, table: bool(copied.extend(row_chunks) or copied)
+
+    operator.execute({})
+
+    mock_snowflake_hook.assert_called_once_with(snowflake_conn_id='snowflake_default', pool_pre_ping=True)
+    mock_snowflake_hook.return_value.fetch_all_if_small.assert_called_once_with(operator.snowflake_query, operator.array_fields, 100_000, 'postgres')
+    # the rows come from the query the probe ran, not from a second one
+    mock_snowflake_hook.return_value.iter_rows.assert_not_called()
+    mock_snowflake_hook.return_value.save_via_stage.assert_not_called()
+
+    mock_postgres_hook.assert_called_once_with(postgres_conn_id='postgres_default', pool_pre_ping=True)
+    mock_postgres_hook.return_value.get_table_metadata.assert_called_once_with(operator.postgres_table, 'public', False)
+    mock_postgres_hook.return_value.create_tmp_table.assert_called_once_with(operator.postgres_table)
+    mock_postgres_hook.return_value.copy_from_iter.assert_called_once_with(ANY, '"column1", "column2"', f'Tmp{operator.postgres_table}')
+    assert copied == [[(1, '{a}')], [(2, '{b}')]]
+    mock_postgres_hook.return_value.copy_rows_direct.assert_not_called()
+    mock_postgres_hook.return_value.write_to_db.assert_not_called()
+    mock_postgres_hook.return_value.swap_db_tables.assert_called_once_with(operator.postgres_table, None)
+    mock_snowflake_hook.return_value.close_pool.assert_called_once()
+    mock_postgres_hook.return_value.close_pool.assert_called_once()
+
+
+def test_execute_small_result(operator, mock_snowflake_hook, mock_postgres_hook):
+    mock_postgres_hook.return_value.get_table_metadata.return_value = ['column1', 'column2']
+    mock_snowflake_hook.return_value.fetch_all_if_small.return_value = ([(1, '{a}')], None)
+
+    operator.execute({})
+
+    mock_snowflake_hook.return_value.fetch_all_if_small.assert_called_once_with(operator.snowflake_query, operator.array_fields, 100_000, 'postgres')
+    mock_snowflake_hook.return_value.iter_rows.assert_not_called()
+    mock_postgres_hook.return_value.get_table_metadata.assert_called_once_with(operator.postgres_table, 'public', False)
+    mock_postgres_hook.return_value.create_tmp_table.assert_called_once_with(operator.postgres_table)
+    mock_postgres_hook.return_value.copy_rows_direct.assert_called_once_with([(1, '{a}')], '"column1", "column2"', f'Tmp{operator.postgres_table}')
+    mock_postgres_hook.return_value.copy_from_iter.assert_not_called()
+    mock_postgres_hook.return_value.write_to_db.assert_not_called()
+    mock_postgres_hook.return_value.swap_db_tables.assert_called_once_with(operator.postgres_table, None)
+    mock_snowflake_hook.return_value.close_pool.assert_called_once()
+    mock_postgres_hook.return_value.close_pool.assert_called_once()
+
+
+def test_execute_small_result_empty(operator):
+    operator.postgres_hook.get_table_metadata.return_value = ['column1', 'column2']
+    operator.snowflake_hook.fetch_all_if_small.return_value = ([], None)
+
+    operator.execute({})
+
+    operator.postgres_hook.create_tmp_table.assert_not_called()
+    operator.postgres_hook.swap_db_tables.assert_not_called()
+    # the pooled sessions are closed on the early exit too
+    operator.snowflake_hook.close_pool.assert_called_once()
+    operator.postgres_hook.close_pool.assert_called_once()
+
+
+def test_execute_no_data(operator):
+    operator.postgres_hook.get_table_metadata.return_value = ['column1', 'column2']
+    operator.small_table_threshold_rows = 0
+    operator.postgres_hook.copy_from_iter.side_effect = lambda row_chunks, columns, table: bool(list(row_chunks))
+    operator.snowflake_hook.iter_rows.return_value = iter([])
+
+    operator.execute({})
+
+    operator.snowflake_hook.fetch_all_if_small.assert_not_called()
+    operator.snowflake_hook.iter_rows.assert_called_once_with(operator.snowflake_query, operator.array_fields, 'postgres')
+    operator.postgres_hook.copy_from_iter.assert_called_once_with(ANY, '"column1", "column2"', f'Tmp{operator.postgres_table}')
+    # The tmp table is dropped instead of being swapped in
+    operator.postgres_hook.swap_db_tables.assert_called_once_with(operator.postgres_table, [])
+
+
+def test_execute_stage_export(operator):
+    operator.use_stage_export = True
+    operator.postgres_hook.get_table_metadata.return_value = ['column1', 'column2']
+    operator.snowflake_hook.save_via_stage.return_value = True
+
+    operator.execute({})
+
+    # the query only runs once, as the stage export
+    operator.snowflake_hook.fetch_all_if_small.assert_not_called()
+    operator.snowflake_hook.save_via_stage.assert_called_once_with(operator.snowflake_query, operator.array_fields, ANY, 'postgres')
+    operator.postgres_hook.write_to_db.assert_called_once_with(ANY, '"column1", "column2"', f'Tmp{operator.postgres_table}')
+    operator.postgres_hook.copy_from_iter.assert_not_called()
+
+
+def test_execute_binary_copy(operator):
+    operator.use_binary_copy = True
+    operator.small_table_threshold_rows = 0
+    operator.postgres_hook.get_table_metadata.return_value = ['column1', 'column2']
+    operator.snowflake_hook.generate_tuples_from_table.return_value = iter([([(1, 'data1')], ['COLUMN1', 'COLUMN2'])])
+    operator.postgres_hook.write_rows_to_db_binary.side_effect = lambda row_chunks, columns, table: bool(list(row_chunks))
+
+    operator.execute({})
+
+    operator.postgres_hook.write_rows_to_db_binary.assert_called_once_with(ANY, ['column1', 'column2'], f'Tmp{operator.postgres_table}')
+    operator.postgres_hook.write_to_db.assert_not_called()
+    operator.postgres_hook.swap_db_tables.assert_called_once_with(operator.postgres_table, None)
+
+
+def test_merge_execute_reads_metadata_once(dag, mock_snowflake_hook, mock_postgres_hook):
+    operator = SnowflakeToPostgresMergeIncrementalOperator(
+        task_id='test_merge',
+        snowflake_query='SELECT * FROM table',
+        postgres_table='postgres_table',
+        primary_key_columns=['id'],
+        dag=dag,
+    )
+    operator.postgres_hook.get_table_metadata.return_value = ['id', 'name']
+    operator.snowflake_hook.fetch_all_if_small.return_value = ([(1, 'a')], None)
+
+    operator.execute({})
+
+    operator.postgres_hook.get_table_metadata.assert_called_once_with('postgres_table', 'public', False)
+    assert operator.columns_to_update == ['name']
+    assert operator.insert_commands == [
+        'insert into "postgres_table" ("name", "id") select "name", "id" from "Tmppostgres_table" on conflict("id") do update set "name"=excluded."name" ;'
+    ]
+
+
+def test_merge_execute_twice(dag, mock_snowflake_hook, mock_postgres_hook):
+    operator = SnowflakeToPostgresMergeIncrementalOperator(
+        task_id='test_merge',
+        snowflake_query='SELECT * FROM table',
+        postgres_table='postgres_table',
+        primary_key_columns=['id'],
+        dag=dag,
+    )
+    postgres_hook = operator.postgres_hook
+    postgres_hook.get_table_metadata.return_value = ['id', 'name']
+    postgres_hook.tmp_table = 'Tmppostgres_table'
+    postgres_hook.sequences = []
+    # the real swap, which adds its cleanup commands to the insert commands
+    postgres_hook.swap_db_tables.side_effect = functools.partial(ExtendedPostgresHook.swap_db_tables, postgres_hook)
+    operator.snowflake_hook.fetch_all_if_small.return_value = ([(1, 'a')], None)
+
+    operator.execute({})
+    operator.execute({})
+
+    insert = 'insert into "postgres_table" ("name", "id") select "name", "id" from "Tmppostgres_table" on conflict("id") do update set "name"=excluded."name" ;'
+    drop = 'drop table if exists "Tmppostgres_table" cascade;'
+    # each run gets the same commands, not the ones left over from the last run
+    assert [c[0][0] for c in postgres_hook._run_psql_commands_in_transaction.call_args_list] == [[insert, drop], [insert, drop]]
+    assert operator._insert_commands == [insert]
+
+
+def test_merge_sql_clauses(dag, mock_snowflake_hook, mock_postgres_hook):
+    operator = SnowflakeToPostgresMergeIncrementalOperator(
+        task_id='test_merge',
+        snowflake_query='SELECT * FROM table',
+        postgres_table='postgres_table',
+        primary_key_columns=['id'],
+        columns_to_update=['name', 'created_at', 'updated_at'],
+        insert_only_columns=['created_at'],
+        conditional_psql_timestamp_column='updated_at',
+        dag=dag,
+    )
+    operator.postgres_hook.get_table_metadata.return_value = ['id', 'name', 'created_at', 'updated_at']
+
+    clauses = operator._sql_clauses
+
+    assert clauses.columns_string == '"id", "name", "created_at", "updated_at"'
+    assert clauses.column_list == '"name", "created_at", "updated_at", "id"'
+    assert clauses.on_conflict_clause == (
+        'on conflict("id") do update set "name"=excluded."name", '
+        '"created_at"=coalesce("postgres_table"."created_at", excluded."created_at"), "updated_at"=excluded."updated_at"'
+    )
+    assert clauses.conditional_timestamp_clause == 'where excluded."updated_at" >= "postgres_table"."updated_at"'
+    # built once
+    assert operator._sql_clauses is clauses
+
+
+def test_merge_sql_clauses_quotes_identifiers(dag, mock_snowflake_hook, mock_postgres_hook):
+    operator = SnowflakeToPostgresMergeIncrementalOperator(
+        task_id='test_merge',
+        snowflake_query='SELECT * FROM table',
+        postgres_table='postgres_table',
+        primary_key_columns=['id'],
+        dag=dag,
+    )
+    operator.postgres_hook.get_table_metadata.return_value = ['id', 'say "hi"']
+
+    clauses = operator._sql_clauses
+
+    assert clauses.columns_string == '"id", "say ""hi"""'
+    assert clauses.on_conflict_clause == 'on conflict("id") do update set "say ""hi"""=excluded."say ""hi"""'
+
+
+def test_bookmark_execute(bookmark_operator, mock_snowflake_hook, mock_postgres_hook, mock_s3_bookmark_hook):
+    mock_s3_bookmark_hook.return_value.get_latest_bookmark.return_value = "'2021-01-11 12:00:00.000'"
+    mock_postgres_hook.return_value.get_table_metadata.return_value = ['id', 'updated_at']
+    next_bookmark = datetime(2021, 1, 12)
+    mock_snowflake_hook.return_value.fetch_all_if_small.return_value = (
+        [(1, datetime(2021, 1, 12), next_bookmark), (2, datetime(2021, 1, 11, 13), next_bookmark)],
+        None,
+    )
+
+    ti = MagicMock()
+    bookmark_operator.execute({'ti': ti})
+
+    # one Snowflake query carries both the rows and the next bookmark
+    assert bookmark_operator.snowflake_query == (
+        'with inner_cte as (SELECT * FROM my_snowflake_table) '
+        'select *, max(updated_at) over () as "_airflow_bookmark" from inner_cte where updated_at > \'2021-01-11 12:00:00.000\''
+    )
+    mock_snowflake_hook.return_value.run.assert_not_called()
+    mock_postgres_hook.return_value.copy_rows_direct.assert_called_once_with(
+        [(1, datetime(2021, 1, 12)), (2, datetime(2021, 1, 11, 13))], '"id", "updated_at"', f'Tmp{bookmark_operator.postgres_table}'
+    )
+    mock_s3_bookmark_hook.return_value.save_next_bookmark.assert_called_once_with(next_bookmark)
+
+
+@patch('vivian_airflow_extensions.hooks.s3_bookmark_hook._s3_client')
+def test_bookmark_execute_aware_bookmark(mock_s3_client, dag, mock_snowflake_hook, mock_postgres_hook):
+    s3_client = mock_s3_client.return_value
+    s3_client.get_object.return_value = {'Body': MagicMock(read=MagicMock(return_value=b'2021-01-11 12:00:00'))}
+    operator = SnowflakeToPostgresBookmarkOperator(
+        task_id='test_task',
+        postgres_table='my_table',
+        snowflake_query='SELECT * FROM my_snowflake_table',
+        primary_key_columns=['id'],
+        incremental_key='updated_at',
+        incremental_key_type='timestamp',
+        bookmark_s3_key='s3://test-bucket/bookmark.txt',
+        dag=dag,
+    )
+    operator.postgres_hook.get_table_metadata.return_value = ['id', 'updated_at']
+    next_bookmark = datetime(2021, 1, 12, 8, 30, tzinfo=timezone(timedelta(hours=-8)))
+    operator.snowflake_hook.fetch_all_if_small.return_value = ([(1, next_bookmark, next_bookmark)], None)
+
+    ti = MagicMock()
+    operator.execute({'ti': ti})
+
+    # the saved bookmark keeps the wall-clock time and matches the XCom
+    saved = s3_client.put_object.call_args[1]['Body'].decode('utf-8')
+    assert saved == '2021-01-12 08:30:00'
+    assert {c[1]['key']: c[1]['value'] for c in ti.xcom_push.call_args_list}['next_bookmark'] == saved
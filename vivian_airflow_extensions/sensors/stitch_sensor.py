@@ -1,24 +1,31 @@
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
 from airflow.sensors.base_sensor_operator import BaseSensorOperator
 from airflow.utils.decorators import apply_defaults
 from airflow.exceptions import AirflowException
 
 from ..hooks.stitch_hook import StitchHook
+from ..triggers.stitch_trigger import StitchStatusTrigger
 
 
 class StitchMonitorSourceSensor(BaseSensorOperator):
     """
-    This class allows for monitoring of Stitch jobs.
+    This class allows for monitoring of Stitch jobs. It runs in reschedule mode by default, so it
+    only holds a worker slot while it checks on the source.
     """
     @apply_defaults
-    def __init__(self, source_id: str=None, client_id: str=None, conn_id: str=None, sleep_time: int=300, timeout: int=86400, start_time: datetime=datetime.now(), *args, **kwargs) -> None:
+    def __init__(self, source_id: str=None, client_id: str=None, conn_id: str=None, sleep_time: int=300, timeout: int=86400, start_time: datetime=None, *args, **kwargs) -> None:
         """
         Initialize a new instance of StitchSensor.
 
         :param stitch_conn_id: The ID of the connection to use.
+        :param sleep_time: The time to wait between checks, unless poke_interval is given.
+        :param start_time: Wait for an extraction that completes after this time. Defaults
+            to when the task first started.
         """
+        kwargs.setdefault('mode', 'reschedule')
+        kwargs.setdefault('poke_interval', sleep_time)
         super().__init__(*args, **kwargs)
 
         if source_id is None:
@@ -36,6 +43,18 @@ class StitchMonitorSourceSensor(BaseSensorOperator):
         self.start_time = start_time
         self.stitch_hook = StitchHook(conn_id=self.conn_id)
 
+    def _get_start_time(self, context) -> datetime:
+        if self.start_time is not None:
+            return self.start_time
+
+        # a rescheduled task instance keeps the start date of its first try
+        ti = context.get('ti')
+        if ti is not None and ti.start_date is not None:
+            # Stitch reports naive UTC times
+            return ti.start_date.astimezone(timezone.utc).replace(tzinfo=None)
+
+        return datetime.now()
+
     def poke(self, context):
         """
         Function called in a loop until it returns True or the task times out.
@@ -44,9 +63,30 @@ class StitchMonitorSourceSensor(BaseSensorOperator):
         :return: Whether the condition is satisfied.
         """
 
-        tic = datetime.now()
+        tic = self._get_start_time(context)
 
         self.stitch_hook.get_credentials()
 
         logging.info(f'Monitoring source: source_id = {self.source_id}')
-        self.stitch_hook.monitor_extraction(sleep_time=self.sleep_time, timeout=self.timeout, source_id=self.source_id, client_id=self.client_id, start_time=tic)
+        return self.stitch_hook.extraction_succeeded(source_id=self.source_id, client_id=self.client_id, start_time=tic)
+
+
+class StitchMonitorSourceDeferrableSensor(StitchMonitorSourceSensor):
+    """
+    Like StitchMonitorSourceSensor, but defers to a StitchStatusTrigger while it waits, so it
+    holds no worker slot at all between checks.
+    """
+    def execute(self, context):
+        tic = self._get_start_time(context)
+
+        self.defer(
+            trigger=StitchStatusTrigger(source_id=self.source_id, client_id=self.client_id, conn_id=self.conn_id, start_time=tic, poll_interval=self.poke_interval),
+            method_name='execute_complete',
+            timeout=timedelta(seconds=self.timeout),
+        )
+
+    def execute_complete(self, context, event=None):
+        if event['status'] == 'error':
+            raise AirflowException(event['message'])
+
+        logging.info(f'Extraction succeeded: source_id = {self.source_id}')
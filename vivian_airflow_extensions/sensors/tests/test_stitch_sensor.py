@@ -1,32 +1,80 @@
-import unittest
 from unittest.mock import patch
 from datetime import datetime
 
+import pytest
+from airflow.exceptions import TaskDeferred
 from airflow.models import DAG
 
-from vivian_airflow_extensions.sensors.stitch_sensor import StitchMonitorSourceSensor
+from vivian_airflow_extensions.sensors.stitch_sensor import StitchMonitorSourceSensor, StitchMonitorSourceDeferrableSensor
+from vivian_airflow_extensions.triggers.stitch_trigger import StitchStatusTrigger
 
-class TestStitchMonitorSourceSensor(unittest.TestCase):
-    def setUp(self):
-        self.dag = DAG('test_dag', start_date=datetime.now())
-        with patch('vivian_airflow_extensions.sensors.stitch_sensor.StitchHook') as self.mock_stitch_hook:
-            self.task = StitchMonitorSourceSensor(
-                task_id='test_task',
-                source_id='test_source_id',
-                client_id='test_client_id',
-                conn_id='test_conn_id',
-                dag=self.dag,
-            )
 
-    def test_poke(self):
-        self.mock_stitch_hook.return_value.monitor_extraction.return_value = True
-        self.mock_stitch_hook.return_value.get_credentials.return_value = True
+@patch('vivian_airflow_extensions.sensors.stitch_sensor.StitchHook')
+def test_poke(mock_stitch_hook):
+    task = StitchMonitorSourceSensor(
+        task_id='test_task',
+        source_id='test_source_id',
+        client_id='test_client_id',
+        conn_id='test_conn_id',
+        dag=DAG('test_dag', start_date=datetime.now()),
+    )
+    mock_stitch_hook.return_value.extraction_succeeded.return_value = True
+    mock_stitch_hook.return_value.get_credentials.return_value = True
 
-        # Execute the operator
-        self.task.poke({})
+    # Execute the operator
+    assert task.poke({}) is True
 
-        # Check that the StitchHook was called with the correct arguments
-        self.mock_stitch_hook.assert_called_with(conn_id='test_conn_id')
+    # Check that the StitchHook was called with the correct arguments
+    mock_stitch_hook.assert_called_with(conn_id='test_conn_id')
+    mock_stitch_hook.return_value.monitor_extraction.assert_not_called()
 
-if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+
+@patch('vivian_airflow_extensions.sensors.stitch_sensor.StitchHook')
+def test_poke_start_time(mock_stitch_hook):
+    start_time = datetime(2022, 1, 1)
+    task = StitchMonitorSourceSensor(
+        task_id='test_task',
+        source_id='test_source_id',
+        client_id='test_client_id',
+        conn_id='test_conn_id',
+        start_time=start_time,
+        dag=DAG('test_dag', start_date=datetime.now()),
+    )
+
+    task.poke({})
+
+    assert mock_stitch_hook.return_value.extraction_succeeded.call_args[1]['start_time'] == start_time
+
+
+@patch('vivian_airflow_extensions.sensors.stitch_sensor.StitchHook')
+def test_reschedule_mode(mock_stitch_hook):
+    task = StitchMonitorSourceSensor(
+        task_id='test_task',
+        source_id='test_source_id',
+        client_id='test_client_id',
+        conn_id='test_conn_id',
+        sleep_time=120,
+        dag=DAG('test_dag', start_date=datetime.now()),
+    )
+
+    assert task.mode == 'reschedule'
+    assert task.poke_interval == 120
+
+
+@patch('vivian_airflow_extensions.sensors.stitch_sensor.StitchHook')
+def test_deferrable_execute(mock_stitch_hook):
+    task = StitchMonitorSourceDeferrableSensor(
+        task_id='test_task',
+        source_id='test_source_id',
+        client_id='test_client_id',
+        conn_id='test_conn_id',
+        start_time=datetime(2022, 1, 1),
+        dag=DAG('test_dag', start_date=datetime.now()),
+    )
+
+    with pytest.raises(TaskDeferred) as deferred:
+        task.execute({})
+
+    assert isinstance(deferred.value.trigger, StitchStatusTrigger)
+    assert deferred.value.trigger.start_time == datetime(2022, 1, 1)
+    mock_stitch_hook.return_value.extraction_succeeded.assert_not_called()
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime
+
+from airflow.exceptions import AirflowException
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+
+from ..hooks.stitch_hook import StitchHook
+
+
+class StitchStatusTrigger(BaseTrigger):
+    """
+    Waits in the triggerer for a Stitch source's last extraction to complete after start_time,
+    so a deferred task doesn't hold a worker slot while Stitch runs.
+    """
+    def __init__(self, source_id: str, client_id: str, conn_id: str, start_time: datetime, poll_interval: int=300) -> None:
+        """
+        :param source_id: The ID of the source to monitor.
+        :param client_id: The client ID to use.
+        :param conn_id: The ID of the connection to use.
+        :param start_time: Wait for an extraction that completes after this time.
+        :param poll_interval: The time to sleep between checks.
+        """
+        super().__init__()
+
+        self.source_id = source_id
+        self.client_id = client_id
+        self.conn_id = conn_id
+        self.start_time = start_time
+        self.poll_interval = poll_interval
+
+    def serialize(self) -> tuple:
+        return (
+            'vivian_airflow_extensions.triggers.stitch_trigger.StitchStatusTrigger',
+            {
+                'source_id': self.source_id,
+                'client_id': self.client_id,
+                'conn_id': self.conn_id,
+                'start_time': self.start_time,
+                'poll_interval': self.poll_interval,
+            },
+        )
+
+    async def run(self):
+        # the hook's connection lookup and requests are blocking, so they run in the default
+        # executor and the event loop only ever waits on them or on asyncio.sleep
+        loop = asyncio.get_running_loop()
+        hook = StitchHook(conn_id=self.conn_id)
+
+        try:
+            await loop.run_in_executor(None, hook.get_credentials)
+            while not await loop.run_in_executor(None, hook.extraction_succeeded, self.source_id, self.client_id, self.start_time):
+                self.log.info(f'Waiting {self.poll_interval} seconds for all extractions to complete: source_id = {self.source_id}')
+                await asyncio.sleep(self.poll_interval)
+        except AirflowException as e:
+            yield TriggerEvent({'status': 'error', 'message': str(e)})
+            return
+
+        yield TriggerEvent({'status': 'success'})
@@ -0,0 +1,44 @@
+import asyncio
+from unittest.mock import patch
+from datetime import datetime
+
+from airflow.exceptions import AirflowException
+
+from vivian_airflow_extensions.triggers.stitch_trigger import StitchStatusTrigger
+
+
+def _collect_events(trigger):
+    async def collect():
+        return [event async for event in trigger.run()]
+
+    return asyncio.run(collect())
+
+
+@patch('vivian_airflow_extensions.triggers.stitch_trigger.StitchHook')
+def test_run(mock_stitch_hook):
+    mock_stitch_hook.return_value.extraction_succeeded.side_effect = [False, True]
+
+    trigger = StitchStatusTrigger('test_source_id', 'test_client_id', 'test_conn_id', datetime(2022, 1, 1), poll_interval=0)
+    events = _collect_events(trigger)
+
+    assert [e.payload for e in events] == [{'status': 'success'}]
+    assert mock_stitch_hook.return_value.extraction_succeeded.call_count == 2
+    mock_stitch_hook.return_value.get_credentials.assert_called_once()
+
+
+@patch('vivian_airflow_extensions.triggers.stitch_trigger.StitchHook')
+def test_run_failed(mock_stitch_hook):
+    mock_stitch_hook.return_value.extraction_succeeded.side_effect = AirflowException('extraction failed')
+
+    trigger = StitchStatusTrigger('test_source_id', 'test_client_id', 'test_conn_id', datetime(2022, 1, 1), poll_interval=0)
+    events = _collect_events(trigger)
+
+    assert [e.payload for e in events] == [{'status': 'error', 'message': 'extraction failed'}]
+
+
+def test_serialize():
+    trigger = StitchStatusTrigger('test_source_id', 'test_client_id', 'test_conn_id', datetime(2022, 1, 1))
+
+    classpath, kwargs = trigger.serialize()
+
+    assert StitchStatusTrigger(**kwargs).serialize() == (classpath, kwargs)